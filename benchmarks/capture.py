@@ -0,0 +1,279 @@
+"""
+Capture latency and memory under Xvfb
+
+    python benchmarks/capture.py [--layouts 1080p,triple-4k] [--repeat 5]
+                                 [--output results.json]
+    python benchmarks/capture.py --compare old.json new.json [--budget 50]
+
+Every layout runs on its own Xvfb server (multi screen layouts use
+xinerama) and every capture runs in a fresh process, that reports the time
+spent on each phase and its peak RSS. The results are the median of the
+runs, written as JSON so they can be compared between commits
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# name -> screens, laid out side by side by xinerama
+LAYOUTS = {
+    "1080p": ["1920x1080"],
+    "1440p": ["2560x1440"],
+    "4k": ["3840x2160"],
+    "dual-1080p": ["1920x1080", "1920x1080"],
+    "1080p+4k": ["1920x1080", "3840x2160"],
+    "triple-4k": ["3840x2160"] * 3,
+}
+
+# strips is a fullscreen capture grabbed and encoded 256 rows at a time, its
+# peak RSS shouldn't grow with the layout size
+SCENARIOS = ["fullscreen", "strips", "region", "xid", "clipboard"]
+
+_phases = {}
+
+
+class Xvfb:
+    def __init__(self, screens):
+        read, write = os.pipe()
+        cmd = ["Xvfb", "-displayfd", str(write), "-nolisten", "tcp"]
+        if len(screens) > 1:
+            cmd.append("+xinerama")
+        for number, size in enumerate(screens):
+            cmd += ["-screen", str(number), "%sx24" % size]
+        self.proc = subprocess.Popen(cmd, pass_fds=[write],
+                                     stderr=subprocess.DEVNULL)
+        os.close(write)
+        with os.fdopen(read) as displayfd:
+            number = displayfd.readline().strip()
+        if not number:
+            raise RuntimeError("Xvfb didn't start")
+        self.display = ":" + number
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def timed(name, function):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _phases[name] = _phases.get(name, 0) + \
+                (time.perf_counter() - start) * 1000
+    return wrapper
+
+
+def worker(scenario, output):
+    """
+    Run a single capture in this process and print its measures as JSON
+    """
+
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from escrotum.app import Escrotum
+    from gi.repository import Gtk as gtk
+    from gi.repository import GLib as glib
+    _phases["import"] = (time.perf_counter() - start) * 1000
+
+    class TimedEscrotum(Escrotum):
+        grab_pixbuf = timed("grab", Escrotum.grab_pixbuf)
+        mask_pixbuf = timed("mask", Escrotum.mask_pixbuf)
+        save_clipboard = timed("clipboard", Escrotum.save_clipboard)
+
+        def save_file(self, *args):
+            self.save_start = time.perf_counter()
+            return Escrotum.save_file(self, *args)
+
+        def on_frame_saved(self, *args):
+            _phases["encode"] = (time.perf_counter() - self.save_start) * 1000
+            return Escrotum.on_frame_saved(self, *args)
+
+    options = dict(filename=output)
+    if scenario == "region":
+        options["geometry"] = [100, 100, 800, 600]
+    elif scenario == "strips":
+        options["strip_height"] = 256
+    elif scenario == "clipboard":
+        options["use_clipboard"] = True
+    elif scenario == "xid":
+        window = gtk.Window()
+        window.set_default_size(800, 600)
+        window.show_all()
+        while not window.get_mapped() or gtk.events_pending():
+            gtk.main_iteration()
+        options["xid"] = window.get_window().get_xid()
+
+    status = []
+
+    def done(code):
+        status.append(code)
+        glib.idle_add(gtk.main_quit)
+
+    start = time.perf_counter()
+    TimedEscrotum(done=done, **options)
+    if not status:
+        gtk.main()
+    _phases["capture"] = (time.perf_counter() - start) * 1000
+
+    print(json.dumps({
+        "status": status[0],
+        "phases": _phases,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def run_scenario(display, scenario, repeat, tmpdir):
+    env = dict(os.environ, DISPLAY=display)
+    output = os.path.join(tmpdir, "escrotum-bench.png")
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, __file__, "--worker", scenario, output],
+            env=env, stdout=subprocess.PIPE, check=True)
+        wall = (time.perf_counter() - start) * 1000
+        run = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+        run["phases"]["wall"] = wall
+        runs.append(run)
+
+    phases = sorted(set(name for run in runs for name in run["phases"]))
+    return {
+        "status": max(run["status"] for run in runs),
+        "phases_ms": {
+            name: round(statistics.median(
+                run["phases"].get(name, 0) for run in runs), 2)
+            for name in phases},
+        "peak_rss_kb": max(run["peak_rss_kb"] for run in runs),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(layouts, scenarios, repeat, tmpdir):
+    results = []
+    for layout in layouts:
+        xvfb = Xvfb(LAYOUTS[layout])
+        try:
+            for scenario in scenarios:
+                result = run_scenario(xvfb.display, scenario, repeat, tmpdir)
+                result.update(layout=layout, scenario=scenario)
+                results.append(result)
+                print("%-12s %-10s capture %8.1fms  peak rss %7d KiB" % (
+                    layout, scenario, result["phases_ms"]["capture"],
+                    result["peak_rss_kb"]), file=sys.stderr)
+        finally:
+            xvfb.close()
+    return {"revision": git_revision(), "repeat": repeat, "results": results}
+
+
+def check_budget(results, budget):
+    """
+    Returns False if a capture took more than budget milliseconds
+    """
+
+    within_budget = True
+    for result in results["results"]:
+        capture = result["phases_ms"]["capture"]
+        if capture > budget:
+            print("%s %s over budget: %.1fms > %sms" % (
+                result["layout"], result["scenario"], capture, budget))
+            within_budget = False
+    return within_budget
+
+
+def check_rss_budget(results, budget):
+    """
+    Returns False if a strips capture peaked over budget KiB of RSS
+    """
+
+    within_budget = True
+    for result in results["results"]:
+        if result["scenario"] != "strips":
+            continue
+        if result["peak_rss_kb"] > budget:
+            print("%s strips over the RSS budget: %sK > %sK" % (
+                result["layout"], result["peak_rss_kb"], budget))
+            within_budget = False
+    return within_budget
+
+
+def compare(old, new):
+    """
+    Print the capture time and peak RSS deltas between two results
+    """
+
+    key = lambda result: (result["layout"], result["scenario"])  # noqa: E731
+    before = {key(result): result for result in old["results"]}
+    print("%-12s %-10s %10s %10s %8s %10s" % (
+        "layout", "scenario", "old ms", "new ms", "delta", "rss delta"))
+    for result in new["results"]:
+        capture = result["phases_ms"]["capture"]
+        previous = before.get(key(result))
+        if previous:
+            old_capture = previous["phases_ms"]["capture"]
+            print("%-12s %-10s %10.1f %10.1f %+7.1f%% %+9dK" % (
+                result["layout"], result["scenario"], old_capture, capture,
+                (capture - old_capture) / old_capture * 100,
+                result["peak_rss_kb"] - previous["peak_rss_kb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--layouts", default="1080p,dual-1080p,4k,triple-4k")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--tmpdir", default="/tmp")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--budget", default=None, type=float,
+                        help="fail when a capture takes more milliseconds")
+    parser.add_argument("--rss-budget", default=None, type=int,
+                        metavar="KIB",
+                        help="fail when the strips peak RSS is bigger")
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(*args.worker)
+        return
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            results = json.load(new)
+            compare(json.load(old), results)
+    else:
+        results = benchmark(args.layouts.split(","),
+                            args.scenarios.split(","), args.repeat,
+                            args.tmpdir)
+        output = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, "w") as fileobj:
+                fileobj.write(output + "\n")
+        else:
+            print(output)
+
+    if args.budget is not None and not check_budget(results, args.budget):
+        sys.exit(1)
+    if args.rss_budget is not None and \
+            not check_rss_budget(results, args.rss_budget):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
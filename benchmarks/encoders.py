@@ -0,0 +1,87 @@
+"""
+Throughput against output size of the escrotum encoders
+
+    python benchmarks/encoders.py [--size 1920x1080] [--formats png,qoi]
+
+The frame is synthetic but screen like: flat areas, gradients and rows of
+noisy "text", so it doesn't need an X server
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrotum.encoder import Image, encode  # noqa: E402
+
+FORMATS = ["png", "qoi", "webp", "pam", "ppm", "bgra", "jpeg"]
+
+
+def make_frame(width, height, channels=3):
+    rng = random.Random(0)
+    row_size = width * channels
+    background = bytes([40, 44, 52, 255][:channels]) * width
+    rows = []
+    for y in range(height):
+        band = (y // 24) % 6
+        if band == 0:
+            # gradient title bar
+            row = bytes(v for x in range(width)
+                        for v in ((x * 255 // width, 80, 160, 255)[:channels]))
+        elif band in (2, 3) and y % 24 < 16:
+            # text like noise on part of the row
+            start = rng.randrange(0, row_size // 2) // channels * channels
+            noise = bytes(rng.choice((40, 200, 230))
+                          for _ in range(row_size // 4))
+            row = background[:start] + noise + background[start + len(noise):]
+        else:
+            row = background
+        rows.append(row[:row_size])
+    return Image(width, height, row_size, channels, b"".join(rows))
+
+
+def run(image, formats, options, repeat):
+    pixels = image.width * image.height
+    raw_size = pixels * image.channels
+    print("%-6s %10s %10s %8s" % ("format", "MPix/s", "size KiB", "ratio"))
+    for filetype in formats:
+        best = None
+        try:
+            for _ in range(repeat):
+                output = io.BytesIO()
+                start = time.perf_counter()
+                encode(output, image, filetype, options)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        except Exception as error:
+            print("%-6s skipped: %s" % (filetype, error))
+            continue
+        size = len(output.getvalue())
+        print("%-6s %10.1f %10.0f %8.3f" % (
+            filetype, pixels / best / 1e6, size / 1024, size / raw_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", default="1920x1080")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--compression", default=6, type=int)
+    parser.add_argument("--strategy", default="default")
+    parser.add_argument("--quality", default=100, type=int)
+    parser.add_argument("--effort", default=4, type=int)
+    parser.add_argument("--repeat", default=3, type=int)
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split("x"))
+    options = dict(compression=args.compression, strategy=args.strategy,
+                   quality=args.quality, effort=args.effort)
+    run(make_frame(width, height), args.formats.split(","), options,
+        args.repeat)
+
+
+if __name__ == "__main__":
+    main()
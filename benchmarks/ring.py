@@ -0,0 +1,83 @@
+"""
+Throughput of the shared memory frame ring
+
+    python benchmarks/ring.py [--sizes 1920x1080,3840x2160] [--seconds 3]
+                              [--slots 8]
+
+A writer process publishes synthetic frames as fast as it can and a reader
+process takes them with zero copy, for both policies. Doesn't need an X
+server
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrotum.encoder import Image  # noqa: E402
+from escrotum.ring import FrameRing, POLICIES  # noqa: E402
+
+
+def reader(name, results):
+    ring = FrameRing.attach(name)
+    frames = 0
+    while True:
+        frame = ring.get(timeout=1)
+        if frame is None:
+            break
+        # touch the first and last pixel, as a reader that uses them would
+        frame.pixels[0] + frame.pixels[len(frame.pixels) - 1]
+        if ring.release(frame):
+            frames += 1
+    results.put((frames, ring.dropped))
+    ring.close()
+
+
+def run(width, height, policy, slots, seconds):
+    image = Image(width, height, width * 4, 4, os.urandom(width * height * 4))
+    name = "escrotum-bench-%s" % os.getpid()
+    ring = FrameRing.create(name, slots, width * height * 4, policy)
+
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=reader, args=(name, results))
+    proc.start()
+    # let the reader attach
+    time.sleep(0.2)
+
+    written = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        ring.put(image)
+        written += 1
+    elapsed = time.monotonic() - start
+    ring.close()
+
+    frames, dropped = results.get()
+    proc.join()
+    return written / elapsed, frames / elapsed, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1920x1080,3840x2160")
+    parser.add_argument("--seconds", default=3, type=float)
+    parser.add_argument("--slots", default=8, type=int)
+    args = parser.parse_args()
+
+    print("%-10s %-6s %12s %12s %10s %8s" % (
+        "size", "policy", "written/s", "read/s", "read MB/s", "dropped"))
+    for size in args.sizes.split(","):
+        width, height = map(int, size.split("x"))
+        for policy in POLICIES:
+            written, read, dropped = run(width, height, policy, args.slots,
+                                         args.seconds)
+            print("%-10s %-6s %12.1f %12.1f %10.1f %8s" % (
+                size, policy, written, read,
+                read * width * height * 4 / 1e6, dropped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""
+escrotum, screenshots and screen recording. The capture API lives in
+escrotum.grab, it's loaded on first use so the command line doesn't pay
+for GTK when it doesn't need it
+"""
+
+__all__ = ["capture", "Capturer", "CaptureError", "Frame"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import grab
+        return getattr(grab, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,950 @@
+import os
+import sys
+import time
+import datetime
+import statistics
+
+import gi
+
+gi.require_version('Gtk', '3.0')  # noqa: E402
+from gi.repository import Gtk as gtk
+from gi.repository import Gdk as gdk
+from gi.repository import GLib as glib
+import cairo
+
+from .util import (get_selected_window, get_window_from_xid,
+                   get_window_geometry, get_output_fd, daemonize)
+from .grab import (grab_pixbuf, mask_pixbuf, get_monitor_geometries,
+                   CaptureError)
+from .encoder import (save, save_strips, run_async, from_pixbuf,
+                      STRIP_FORMATS)
+from .timings import Timings
+from .main import (EXIT_XID_ERROR, EXIT_INVALID_PIXBUF, EXIT_CANT_SAVE_IMAGE,
+                   EXIT_CANCEL, EXIT_CANT_GRAB_MOUSE, EXIT_FFMPEG_ERROR)
+
+# milliseconds from the end of the selection to the capture, the daemon keeps
+# them for all the requests
+_selection_latencies = []
+
+
+class Escrotum(gtk.Dialog):
+    def __init__(self, filename=None, selection=False, xid=None, delay=None,
+                 selection_delay=250, countdown=False, use_clipboard=False,
+                 commands=None, record=False, use_shm=True, burst=1,
+                 interval=1000, geometry=None, done=None,
+                 encoder_options=None, stop_key="<Ctrl><Alt>s",
+                 timings=False, timelapse=None, timings_log=None,
+                 hook_timeout=None, detach_hooks=False, filetype=None,
+                 strip_height=None, ring=None, ring_slots=8,
+                 ring_policy="drop", segment_time=None, segment_wrap=None,
+                 replay=None, profile="auto", fps=30, transcode=False,
+                 transcode_slots=1):
+        super(Escrotum, self).__init__(type=gtk.WindowType.POPUP)
+
+        self.started = False
+        gdk.event_handler_set(self.event_handler)
+
+        # set when running inside the daemon, called instead of exit
+        self.done = done
+        self.daemon = done is not None
+        self.finished = False
+        self.ffmpeg = None
+
+        # --exec hooks, see hooks.py
+        self.commands = commands or []
+        self.hook_timeout = hook_timeout
+        self.detach_hooks = detach_hooks
+        self.hooks_running = 0
+
+        self.use_clipboard = use_clipboard
+
+        screen = self.get_screen()
+        self.display = gdk.Display.get_default()
+        self.visual = screen.get_rgba_visual()
+
+        self.rgba_support = False
+        if (self.visual is not None and screen.is_composited()):
+            self.rgba_support = True
+            self.set_visual(self.visual)
+
+        self.filename = filename
+        if not filename:
+            ext = "png"
+            if record:
+                from .ffmpeg import get_extension
+                ext = get_extension(profile)
+            # every frame of a burst needs its own file
+            frame = "_$n" if burst > 1 else ""
+            self.filename = f"%Y-%m-%d-%H%M%S_$wx$h{frame}_escrotum.{ext}"
+        self.template = self.filename
+        # format of the images, from the filename extension when not set
+        self.filetype = filetype
+        # writing to stdout or an inherited file descriptor
+        self.stream = get_output_fd(self.filename) is not None
+        # rows grabbed and encoded at a time, None for the whole image
+        self.strip_height = strip_height
+
+        self.delay = delay
+        self.selection_delay = selection_delay
+        self.selection = selection
+        self.xid = xid
+        self.countdown = countdown
+        self.record = record
+        self.stop_key = stop_key
+        # segmented and replay recordings, see ffmpeg.py
+        self.segment_time = segment_time
+        self.segment_wrap = segment_wrap
+        self.replay = replay
+        # codec settings of the recording and its frame rate
+        self.profile = profile
+        self.fps = fps
+        # record lossless and encode on the transcode queue, transcode.py
+        self.transcode = transcode
+        self.transcode_slots = transcode_slots
+        self.timings = timings
+        # file where the timing records are appended, $ESCROTUM_TIMINGS
+        self.timings_log = timings_log
+        self.released_at = None
+        # timing record of the frame being taken
+        self.timer = Timings(frame=1, daemon=done is not None)
+
+        # pointer motion is applied at most once per frame clock tick
+        self.pointer = None
+        self.update_pending = False
+        self.shown = False
+        self.shape_size = None
+        self.motion_events = self.redraws = 0
+        self.use_shm = use_shm
+
+        self.burst = burst
+        self.interval = interval
+        self.frame = 0
+        self.burst_start = None
+        self.selected_xid = None
+        # directory of the timelapse and its writer, made on the first frame
+        self.timelapse = timelapse
+        self.timelapse_writer = None
+        # name of the shared memory ring and the ring, see ring.py
+        self.ring = ring
+        self.ring_slots = ring_slots
+        self.ring_policy = ring_policy
+        self.frame_ring = None
+
+        # compression, strategy, quality and effort of the encoders
+        self.encoder_options = encoder_options or {}
+        # frames being encoded on the background
+        self.saving = 0
+
+        if record:
+            from .ffmpeg import get_profile
+            try:
+                self.profile = get_profile(profile, self.filename)
+            except ValueError as error:
+                print(error)
+                self.quit(EXIT_FFMPEG_ERROR)
+                return
+            if transcode and self.profile == "ffv1":
+                print("The recording is already lossless, nothing to "
+                      "transcode")
+                self.quit(EXIT_FFMPEG_ERROR)
+                return
+
+        if not xid:
+            self.root = gdk.get_default_root_window()
+        else:
+            self.root = get_window_from_xid(xid)
+        self.root.show()
+
+        self.x = self.y = 0
+        self.start_x = self.start_y = 0
+        self.height = self.width = 0
+        self.geometry = geometry
+
+        self.set_app_paintable(True)
+
+        self.set_keep_above(True)
+        self.connect("draw", self.on_expose)
+
+        if delay:
+            self.timer.begin("delay")
+            if countdown:
+                sys.stdout.write("Taking shot in ..%s" % delay)
+                sys.stdout.flush()
+            glib.timeout_add(1000, self.start)
+        else:
+            self.start()
+
+        self.painted = False
+
+    def start(self):
+        if self.delay:
+            self.delay -= 1
+            if self.countdown:
+                sys.stdout.write(" ..%s" % self.delay)
+                sys.stdout.flush()
+            return True
+        if self.delay == 0 and self.countdown:
+            print(".")
+        self.timer.end("delay")
+
+        if self.geometry:
+            self.x, self.y, self.width, self.height = self.geometry
+            self.capture()
+        elif self.selection and not self.xid:
+            self.grab()
+        else:
+            self.width, self.height = self.root.get_width(), self.root.get_height()
+            self.capture()
+
+    def draw(self):
+        self.painted = True
+        if self.rgba_support or self.width < 4 or self.height < 4:
+            return
+        # the shape only depends on the size
+        if self.shape_size == (self.width, self.height):
+            return
+        self.shape_size = (self.width, self.height)
+
+        outer = cairo.Region(cairo.RectangleInt(0, 0, self.width, self.height))
+        inner = cairo.Region(
+            cairo.RectangleInt(2, 2, self.width - 4, self.height - 4))
+
+        outer.subtract(inner)
+        self.shape_combine_region(outer)
+
+    def on_expose(self, widget, cr):
+        window = self.get_window()
+        width, height = window.get_width(), window.get_height()
+
+        def set_source(r, g, b, a):
+            if not self.rgba_support:
+                cr.set_source_rgb(r, g, b)
+            else:
+                cr.set_source_rgba(r, g, b, a)
+
+        set_source(255, 255, 255, 0.1)
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+
+        set_source(255, 255, 255, 0.8)
+        cr.set_line_width(1)
+        cr.rectangle(0, 0, width, height)
+        cr.set_line_join(cairo.LINE_JOIN_MITER)
+        cr.stroke()
+
+        set_source(0, 0, 0, 0.8)
+        cr.set_line_width(1)
+        cr.rectangle(1, 1, width-1, height-1)
+        cr.set_line_join(cairo.LINE_JOIN_MITER)
+        cr.stroke()
+
+        self.draw()
+
+    def grab(self):
+        """
+        Grab keyboard and mouse
+        """
+
+        seat = self.display.get_default_seat()
+
+        capabilities = (gdk.SeatCapabilities.ALL_POINTING |
+                        gdk.SeatCapabilities.KEYBOARD)
+        owner_events = False
+        cursor = gdk.Cursor(gdk.CursorType.CROSSHAIR)
+        self.timer.begin("selection")
+        status = seat.grab(self.root, capabilities, owner_events, cursor)
+        if status is not gdk.GrabStatus.SUCCESS:
+            self.quit(EXIT_CANT_GRAB_MOUSE)
+
+    def ungrab(self):
+        """
+        Ungrab the mouse and keyboard
+        """
+
+        seat = self.display.get_default_seat()
+        seat.ungrab()
+
+    @property
+    def click_selection(self):
+        """
+        if no motion(click and release) it's a selection of a window
+        """
+        return self.selection and self.width < 5 and self.height < 5
+
+    def event_handler(self, event):
+        """
+        Handle mouse and keyboard events
+        """
+
+        if event.type == gdk.EventType.BUTTON_PRESS:
+            if event.button.button != 1:
+                print("Canceled by the user")
+                self.ungrab()
+                self.quit(EXIT_CANCEL)
+                return
+
+            self.started = True
+            self.start_x = int(event.x)
+            self.start_y = int(event.y)
+            self.move(self.x, self.y)
+            self.queue_draw()
+
+        elif event.type == gdk.EventType.KEY_RELEASE:
+            if gdk.keyval_name(event.keyval) == "Escape":
+                print("Canceled by the user")
+                self.ungrab()
+                self.quit(EXIT_CANCEL)
+                return
+
+        elif event.type == gdk.EventType.MOTION_NOTIFY:
+            if not self.started:
+                return
+
+            self.motion_events += 1
+            self.pointer = (event.x, event.y)
+            if self.update_pending:
+                return
+            if self.get_mapped():
+                self.update_pending = True
+                self.add_tick_callback(self.on_tick)
+            else:
+                self.update_rect()
+
+        elif event.type == gdk.EventType.BUTTON_RELEASE:
+            if not self.started:
+                return
+
+            self.update_pending = False
+            self.set_rect_size(event.x, event.y)
+            self.queue_draw()
+
+            self.released_at = time.monotonic()
+            self.timer.end("selection")
+            self.timer.begin("wait")
+            if self.timings:
+                sys.stderr.write("selection %s motion events, %s redraws\n" %
+                                 (self.motion_events, self.redraws))
+            self.ungrab()
+            self.wait()
+        else:
+            gtk.main_do_event(event)
+
+    def on_tick(self, widget, clock):
+        if self.update_pending:
+            self.update_pending = False
+            self.update_rect()
+        return False
+
+    def update_rect(self):
+        """
+        Move and resize the selection to the last pointer position
+        """
+
+        self.redraws += 1
+        self.set_rect_size(*self.pointer)
+        self.draw()
+
+        if self.width > 3 and self.height > 3:
+            self.resize(self.width, self.height)
+            self.move(self.x, self.y)
+            if not self.shown:
+                self.shown = True
+                self.show_all()
+        self.queue_draw()
+
+    def wait(self):
+        """
+        wait until the window is repainted, so borders/shadows
+        don't appear on the image
+        """
+
+        # if it's a window selection, don't wait
+        if self.click_selection:
+            self.capture()
+            return
+
+        self.painted = False
+        if self.rgba_support:
+            self.set_opacity(0)
+        self.resize(1, 1)
+        self.move(-10, -10)
+
+        def wait():
+            if not self.painted:
+                return True
+            if self.rgba_support:
+                self.wait_compositor()
+            else:
+                # a delay between hiding selection and the screenshot, looks
+                # like we can't trust in sync between window repaint and
+                # composite image
+                # https://github.com/Roger/escrotum/issues/15#issuecomment-85705733
+                glib.timeout_add(self.selection_delay, self.capture)
+
+        glib.timeout_add(10, wait)
+
+    def wait_compositor(self):
+        """
+        Capture as soon as the compositor reports it presented the frame
+        with the selection hidden (_NET_WM_FRAME_DRAWN/_NET_WM_FRAME_TIMINGS
+        through the frame clock), selection_delay is only the fallback for
+        compositors that don't report frames
+        """
+
+        clock = self.get_frame_clock()
+        counter = clock.get_frame_counter()
+        handlers = []
+
+        def capture():
+            if not handlers:
+                return False
+            clock.disconnect(handlers.pop())
+            clock.end_updating()
+            self.capture()
+            return False
+
+        def after_paint(clock):
+            timings = clock.get_timings(counter)
+            if (timings and timings.get_complete() and
+                    timings.get_presentation_time()):
+                capture()
+
+        handlers.append(clock.connect("after-paint", after_paint))
+        # keep frames coming until the compositor answers
+        clock.begin_updating()
+        glib.timeout_add(self.selection_delay, capture)
+
+    def capture(self):
+        """
+        Capture the image/video based on the window size or the selected window
+        """
+
+        if self.finished:
+            return
+
+        self.frame += 1
+        now = time.monotonic()
+        if self.frame > 1:
+            self.timer = Timings(frame=self.frame, daemon=self.daemon)
+        self.timer.end("wait")
+        if self.released_at is not None and self.frame == 1:
+            _selection_latencies.append((now - self.released_at) * 1000)
+            if self.timings:
+                sys.stderr.write(
+                    "selection to capture %.1fms, median %.1fms of %s\n" % (
+                        _selection_latencies[-1],
+                        statistics.median(_selection_latencies),
+                        len(_selection_latencies)))
+        if self.burst_start is None:
+            self.burst_start = now
+        elif self.burst != 1:
+            target = self.burst_start + (self.frame - 1) * self.interval / 1000
+            sys.stderr.write("frame %s jitter %+.1fms\n" %
+                             (self.frame, (now - target) * 1000))
+
+        x, y = (self.x, self.y)
+        window = self.root
+        width, height = self.width, self.height
+
+        # get image/video of the selected window
+        if self.click_selection:
+            # keep the window picked on the first frame of a burst
+            if not self.selected_xid:
+                self.selected_xid = get_selected_window()
+            geometry = None
+            if self.selected_xid:
+                geometry = get_window_geometry(self.selected_xid)
+            if not geometry:
+                print("Can't get the xid of the selected window")
+                self.quit(EXIT_XID_ERROR)
+                return
+            x, y, width, height = geometry
+
+        if self.record:
+            self.capture_video(x, y, width, height)
+        else:
+            self.capture_image(x, y, width, height, window)
+
+    def on_exit(self, width, height):
+        if self.commands:
+            self.call_exec(self.filename, width, height, self.quit)
+        else:
+            self.quit()
+
+    def quit(self, status=0):
+        """
+        Finish the capture, exits unless escrotum runs as a daemon, where
+        the request is answered instead
+        """
+
+        self.cleanup()
+        if not self.daemon:
+            exit(status)
+        if self.finished:
+            return
+        self.finished = True
+        # a recording stops while other requests are being served
+        if not self.record:
+            gdk.event_handler_set(gtk.main_do_event)
+        self.destroy()
+        self.reply(status)
+
+    def cleanup(self):
+        """
+        Close the ring and the timelapse, also when the burst is stopped
+        with Ctrl+C
+        """
+
+        if self.frame_ring:
+            # the readers see it closed once they took the last frames
+            self.frame_ring.close()
+            self.frame_ring = None
+        if self.timelapse_writer:
+            # after the frames still being added
+            run_async(self.timelapse_writer.close).result()
+            self.timelapse_writer = None
+
+    def reply(self, status=0):
+        """
+        Answer the daemon request, only the first reply counts
+        """
+
+        done, self.done = self.done, None
+        if done:
+            done(status)
+
+    def capture_image(self, x, y, width, height, window):
+        # only fetch the pixels of the selection clipped to the window
+        root_width, root_height = window.get_width(), window.get_height()
+        # what is left or above the window is cut, not shifted into it
+        width += min(x, 0)
+        height += min(y, 0)
+        x, y = max(x, 0), max(y, 0)
+        width = min(width, root_width - x)
+        height = min(height, root_height - y)
+
+        if width > 0 and height > 0 and self.use_strips():
+            self.save_strips(window, x, y, width, height)
+            if self.more_frames:
+                self.next_frame()
+            return
+
+        timer = self.timer
+        pb = None
+        if width > 0 and height > 0:
+            with timer.phase("grab"):
+                pb = self.grab_pixbuf(window, x, y, width, height)
+        if pb:
+            timer.add_pixels(width, height, pb.get_byte_length())
+            # mask the pixbuf if we have more than one screen
+            with timer.phase("mask"):
+                pb = self.mask_pixbuf(pb, x, y, width, height)
+
+        if not pb:
+            print("Invalid Pixbuf")
+            self.quit(EXIT_INVALID_PIXBUF)
+            return
+        if self.use_clipboard:
+            if self.save_clipboard(pb):
+                self.on_saved('[CLIPBOARD]', None, width, height, timer)
+        elif self.timelapse:
+            self.save_timelapse(pb, width, height)
+        elif self.ring:
+            self.save_ring(pb, x, y, width, height)
+        else:
+            self.save_file(pb, width, height)
+
+        # the next frame doesn't wait for this one to be encoded
+        if self.more_frames:
+            self.next_frame()
+
+    @property
+    def more_frames(self):
+        """
+        if the burst isn't over, a burst of 0 never ends
+        """
+        return not self.burst or self.frame < self.burst
+
+    def on_saved(self, filename, error, width, height, timer):
+        """
+        Called on the main loop once the frame is stored
+        """
+
+        if error:
+            print(error)
+            self.quit(EXIT_CANT_SAVE_IMAGE)
+            return
+        if not (self.use_clipboard or self.timelapse or self.ring or
+                self.stream):
+            print(filename)
+
+        def done():
+            timer.end("exec")
+            self.on_frame_done(filename, width, height, timer)
+
+        if self.commands:
+            timer.begin("exec")
+            self.call_exec(filename, width, height, done)
+        else:
+            done()
+
+    def on_frame_done(self, filename, width, height, timer):
+        """
+        Called once the frame is stored and its hooks finished
+        """
+
+        if self.more_frames or self.saving or self.hooks_running:
+            self.report_timings(timer, filename, width, height)
+            return
+        # daemonize here so we don't mess with the CWD on subprocess
+        if self.use_clipboard and not self.daemon:
+            # stderr is gone once daemonized, only the log gets that phase
+            self.report_timings(timer, filename, width, height, log=False)
+            with timer.phase("daemonize"):
+                daemonize()
+            self.report_timings(timer, filename, width, height, stderr=False)
+        else:
+            self.report_timings(timer, filename, width, height)
+            # exit here instead of inside save_file
+            self.quit()
+
+    def report_timings(self, timer, filename, width, height, stderr=True,
+                       log=True):
+        """
+        Write the timing record of the frame on stderr with --timings and on
+        the timings log
+        """
+
+        stderr = stderr and self.timings
+        log = self.timings_log if log else None
+        if stderr or log:
+            timer.report(stderr, log, filename=filename, width=width,
+                         height=height)
+
+    def next_frame(self):
+        """
+        Schedule the next frame of the burst, relative to the first one so
+        the timer errors don't add up
+        """
+
+        target = self.burst_start + self.frame * self.interval / 1000
+        delay = max(0, int((target - time.monotonic()) * 1000))
+        glib.timeout_add(delay, self.capture)
+
+    def grab_pixbuf(self, window, x, y, width, height):
+        return grab_pixbuf(window, x, y, width, height, self.use_shm)
+
+    def capture_video(self, x, y, width, height):
+        from .ffmpeg import Ffmpeg
+        from .keybinding import GrabKeyboard
+
+        try:
+            self.keyboard = GrabKeyboard(self.stop_recording, self.stop_key)
+        except ValueError as error:
+            print(error)
+            self.quit(EXIT_FFMPEG_ERROR)
+            return
+
+        self.filename = self._expand_argument(width, height, self.template)
+        output, profile = self.filename, self.profile
+        if self.transcode:
+            # cheap lossless capture, encoded once the recording stops
+            output, profile = self.filename + ".capture.mkv", "ffv1"
+        try:
+            ffmpeg = Ffmpeg(x, y, width, height, output,
+                            self.segment_time, self.segment_wrap, self.replay,
+                            profile, self.fps)
+        except (OSError, ValueError) as error:
+            self.keyboard.ungrab_keys()
+            print(error)
+            self.quit(EXIT_FFMPEG_ERROR)
+            return
+        if not ffmpeg.start():
+            self.keyboard.ungrab_keys()
+            print("ffmpeg can't record video")
+            self.quit(EXIT_FFMPEG_ERROR)
+            return
+        if self.replay:
+            print("Keeping the last %ss, save them with %s" % (
+                self.replay, self.stop_key))
+        else:
+            print("Recording video, stop with %s" % self.stop_key)
+
+        self.ffmpeg = ffmpeg
+        self.video_size = (width, height)
+        # the daemon keeps serving requests while recording
+        self.reply()
+
+    def stop_recording(self):
+        if not self.ffmpeg:
+            return
+        self.keyboard.ungrab_keys()
+        ffmpeg, self.ffmpeg = self.ffmpeg, None
+        # joining the segments copies all of them, not on the main loop
+        future = run_async(ffmpeg.stop)
+        future.add_done_callback(lambda future: glib.idle_add(
+            self.on_recording_stopped, ffmpeg, future))
+
+    def on_recording_stopped(self, ffmpeg, future):
+        joined = future.exception() is None and future.result()
+        stats = ffmpeg.get_stats()
+        if stats:
+            print(stats)
+        if not joined:
+            print("Can't join the segments, they are on %s" % ffmpeg.segments)
+            self.quit(EXIT_FFMPEG_ERROR)
+            return
+        if self.transcode:
+            self.queue_transcode(ffmpeg)
+            return
+        self.on_exit(*self.video_size)
+
+    def queue_transcode(self, ffmpeg):
+        """
+        Leave the capture on the transcode queue, the --exec hooks run once
+        the final file is there
+        """
+
+        from .hooks import build
+        from .transcode import TranscodeQueue
+
+        width, height = self.video_size
+        values = dict(f=self.filename, w=width, h=height, n=self.frame)
+        hooks = [build(command, values) for command in self.commands]
+        frames = ffmpeg.progress.get("frame")
+        try:
+            TranscodeQueue().submit(
+                ffmpeg.output, self.filename, self.profile, width, height,
+                self.fps, frames=int(frames) if frames else None,
+                hooks=hooks, hook_timeout=self.hook_timeout,
+                slots=self.transcode_slots)
+        except OSError as error:
+            print("Can't queue the transcode, the capture is on %s: %s" % (
+                ffmpeg.output, error))
+            self.quit(EXIT_FFMPEG_ERROR)
+            return
+        print("Transcoding to %s on the background, see "
+              "python -m escrotum.transcode" % self.filename)
+        self.quit()
+
+    def mask_pixbuf(self, pb, x, y, width, height):
+        return mask_pixbuf(pb, x, y, width, height,
+                           get_monitor_geometries(self.display))
+
+    def save_clipboard(self, pb):
+        """
+        Own the clipboard with the pixbuf, it's only encoded when pasted.
+        escrotum would be alive until the clipboard owner is changed, unless
+        it runs as a daemon
+        """
+
+        from .clipboard import ClipboardImage
+
+        on_lost = None if self.daemon else exit
+        image = ClipboardImage(pb, self.encoder_options, on_lost)
+        if not image.owned:
+            print("Can't own the clipboard")
+            self.quit(EXIT_CANT_SAVE_IMAGE)
+            return False
+        return True
+
+    def _expand_argument(self, width, height, string):
+        string = datetime.datetime.now().strftime(string)
+        string = string.replace("$w", str(width))
+        string = string.replace("$h", str(height))
+        string = string.replace("$n", str(self.frame))
+        string = os.path.expanduser(string)
+        return string
+
+    def save_file(self, pb, width, height):
+        """
+        Stores the pixbuf as a file, the encoding is done on a thread and
+        on_saved is called once it's written
+        """
+
+        # the name uses the capture time, not the time it's written
+        filename = self._expand_argument(width, height, self.template)
+        self.filename = filename
+        timer = self.timer
+
+        def done(future):
+            glib.idle_add(self.on_frame_saved, filename, future, width, height,
+                          timer)
+
+        self.saving += 1
+        future = run_async(timer.timed("encode", save), pb, filename,
+                           self.get_filetype(filename), self.get_options())
+        future.add_done_callback(done)
+
+    def get_filetype(self, filename):
+        filetype = self.filetype or "png"
+        if not self.filetype and "." in filename and not self.stream:
+            filetype = filename.rsplit(".", 1)[1]
+        if filetype == "jpg":
+            filetype = "jpeg"
+        return filetype
+
+    def get_options(self):
+        # the file has to be on disk before the hooks get it
+        return dict(self.encoder_options,
+                    fsync=bool(self.commands) and not self.stream)
+
+    def use_strips(self):
+        """
+        if the image can be grabbed and stored a strip at a time
+        """
+
+        if not self.strip_height or self.use_clipboard or self.timelapse or \
+                self.ring:
+            return False
+        filename = self._expand_argument(0, 0, self.template)
+        return self.get_filetype(filename) in STRIP_FORMATS
+
+    def save_strips(self, window, x, y, width, height):
+        """
+        Grab, mask and store the region a strip of rows at a time, so the
+        memory used doesn't depend on its size. Done on the main loop, the
+        strips are compressed on the encoder threads while the next one is
+        grabbed
+        """
+
+        filename = self._expand_argument(width, height, self.template)
+        self.filename = filename
+        timer = self.timer
+
+        def strips():
+            for top in range(0, height, self.strip_height):
+                rows = min(self.strip_height, height - top)
+                pb = self.grab_pixbuf(window, x, y + top, width, rows)
+                if not pb:
+                    # the file written so far is removed
+                    raise CaptureError("Invalid Pixbuf")
+                timer.add_pixels(width, rows, pb.get_byte_length())
+                yield self.mask_pixbuf(pb, x, y + top, width, rows)
+
+        error = None
+        with timer.phase("strips"):
+            try:
+                save_strips(strips(), filename, self.get_filetype(filename),
+                            width, height, self.get_options())
+            except CaptureError as e:
+                print(e)
+                self.quit(EXIT_INVALID_PIXBUF)
+                return
+            except Exception as e:
+                error = e
+        self.on_saved(filename, error, width, height, timer)
+
+    def save_timelapse(self, pb, width, height):
+        """
+        Add the pixbuf to the timelapse, only the tiles that changed since
+        the previous frame are stored
+        """
+
+        from .timelapse import TimelapseWriter
+
+        if self.timelapse_writer is None:
+            try:
+                self.timelapse_writer = TimelapseWriter(
+                    self.timelapse, width, height, pb.get_n_channels())
+            except OSError as error:
+                print(error)
+                self.quit(EXIT_CANT_SAVE_IMAGE)
+                return
+            print(self.timelapse)
+
+        timer = self.timer
+
+        def done(future):
+            glib.idle_add(self.on_frame_saved, self.timelapse, future, width,
+                          height, timer)
+
+        # on the saver thread, so the frames are added in order
+        self.saving += 1
+        future = run_async(
+            timer.timed("encode", self.timelapse_writer.add_pixbuf), pb,
+            time.time())
+        future.add_done_callback(done)
+
+    def save_ring(self, pb, x, y, width, height):
+        """
+        Publish the frame on the shared memory ring, the readers map it as
+        is. The ring slots are sized for the first frame
+        """
+
+        from .ring import FrameRing
+
+        timer = self.timer
+        image = from_pixbuf(pb)
+        error = None
+        with timer.phase("ring"):
+            try:
+                if self.frame_ring is None:
+                    self.frame_ring = FrameRing.create(
+                        self.ring, self.ring_slots,
+                        image.rowstride * image.height, self.ring_policy)
+                    print(self.ring)
+                self.frame_ring.put(image, x, y)
+            except (OSError, ValueError) as e:
+                error = e
+        self.on_saved(self.ring, error, width, height, timer)
+
+    def on_frame_saved(self, filename, future, width, height, timer):
+        self.saving -= 1
+        self.on_saved(filename, future.exception(), width, height, timer)
+
+    def call_exec(self, filename, width, height, done):
+        """
+        Run the --exec hooks, done is called on the main loop once they
+        finished. Detached hooks and the ones of the daemon don't make the
+        capture wait
+        """
+
+        from .hooks import build, detach, get_runner
+
+        values = dict(f=filename, w=width, h=height, n=self.frame)
+        hooks = [build(command, values) for command in self.commands]
+        # the image goes to fd 1, the hooks output can't
+        stdout = 2 if get_output_fd(self.template) == 1 else None
+        if self.detach_hooks:
+            detach(hooks, self.hook_timeout, stdout)
+        elif self.daemon:
+            # the daemon outlives the request, its hooks run on its own
+            get_runner().run(hooks, self.hook_timeout, cwd=os.getcwd(),
+                             stdout=stdout)
+        else:
+            def finished():
+                self.hooks_running -= 1
+                done()
+
+            self.hooks_running += 1
+            get_runner().run(hooks, self.hook_timeout,
+                             lambda: glib.idle_add(finished), stdout=stdout)
+            return
+        done()
+
+    def set_rect_size(self, pointer_x, pointer_y):
+        """
+        Set the window size
+        """
+
+        if pointer_x < self.start_x:
+            x = int(pointer_x)
+            width = self.start_x - x
+        else:
+            x = self.start_x
+            width = int(pointer_x) - self.start_x
+
+        self.x = x
+        self.width = width
+
+        if pointer_y < self.start_y:
+            y = int(pointer_y)
+            height = self.start_y - y
+        else:
+            height = int(pointer_y) - self.start_y
+            y = self.start_y
+
+        self.y = y
+        self.height = height
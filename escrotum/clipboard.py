@@ -0,0 +1,83 @@
+"""
+Clipboard owner that encodes the image only when something pastes it
+"""
+
+import io
+
+from gi.repository import Gtk as gtk
+from gi.repository import Gdk as gdk
+from gi.repository import GdkPixbuf as Pixbuf
+
+from .encoder import encode, from_pixbuf
+
+# advertised target -> encoder filetype
+TARGETS = {
+    "image/png": "png",
+    "image/bmp": "bmp",
+    "image/jpeg": "jpeg",
+    "image/x-qoi": "qoi",
+}
+
+
+class ClipboardImage:
+    def __init__(self, pb, options=None, on_lost=None):
+        """
+        Own the clipboard with the pixbuf, on_lost is called when another
+        application takes it
+        """
+
+        self.pixbuf = pb
+        self.options = options or {}
+        self.on_lost = on_lost
+        # target filetype -> encoded bytes
+        self.cache = {}
+
+        self.widget = gtk.Invisible()
+        self.widget.realize()
+        self.widget.connect("selection-get", self.on_selection_get)
+        self.widget.connect("selection-clear-event", self.on_selection_clear)
+
+        selection = gdk.SELECTION_CLIPBOARD
+        for info, target in enumerate(TARGETS):
+            gtk.selection_add_target(self.widget, selection,
+                                     gdk.Atom.intern(target, False), info)
+        self.owned = gtk.selection_owner_set(self.widget, selection,
+                                             gdk.CURRENT_TIME)
+
+    def encode(self, pb, filetype):
+        output = io.BytesIO()
+        encode(output, from_pixbuf(pb), filetype, self.options)
+        return output.getvalue()
+
+    def get_data(self, filetype):
+        """
+        The image encoded as filetype, once the png is there the pixels are
+        dropped and the other formats are decoded from it
+        """
+
+        if filetype in self.cache:
+            return self.cache[filetype]
+
+        if "png" not in self.cache:
+            self.cache["png"] = self.encode(self.pixbuf, "png")
+            self.pixbuf = None
+        if filetype != "png":
+            loader = Pixbuf.PixbufLoader.new_with_type("png")
+            loader.write(self.cache["png"])
+            loader.close()
+            self.cache[filetype] = self.encode(loader.get_pixbuf(), filetype)
+        return self.cache[filetype]
+
+    def on_selection_get(self, widget, selection_data, info, time):
+        target = selection_data.get_target()
+        filetype = TARGETS.get(target.name())
+        if filetype:
+            selection_data.set(target, 8, self.get_data(filetype))
+
+    def on_selection_clear(self, widget, event):
+        self.cache.clear()
+        self.pixbuf = None
+        self.widget.destroy()
+        if self.on_lost:
+            self.on_lost()
+        return True
@@ -0,0 +1,191 @@
+"""
+Capture daemon, keeps GTK, the X connection and the capture buffers warm and
+serves the requests of the escrotum clients over a unix socket, one at a time
+"""
+
+import io
+import os
+import sys
+import json
+import stat
+import socket
+import struct
+import collections
+
+
+def get_private_dir():
+    """
+    Directory only this user can use, for when there is no XDG_RUNTIME_DIR.
+    Anyone could make a socket on /tmp before us
+    """
+
+    path = "/tmp/escrotum-%s" % os.getuid()
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & 0o077):
+        raise ConnectionError("%s isn't a private directory" % path)
+    return path
+
+
+def get_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or get_private_dir()
+    display = os.environ.get("DISPLAY", "").replace("/", "_")
+    name = "escrotum-%s-%s.sock" % (os.getuid(), display)
+    return os.path.join(runtime_dir, name)
+
+
+def forward(request):
+    """
+    Send the request to the running daemon and print its output and errors.
+    Returns the exit status, or None if there is no daemon
+    """
+
+    path = get_socket_path()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+
+    with client:
+        # the requests have the cwd, filenames and commands to run
+        creds = client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                  struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            raise ConnectionError("%s belongs to another user" % path)
+        client.sendall(json.dumps(request).encode() + b"\n")
+        reply = client.makefile("rb").readline()
+
+    if not reply:
+        raise ConnectionError("the daemon closed the connection")
+    reply = json.loads(reply)
+    sys.stdout.write(reply["output"])
+    sys.stdout.flush()
+    # jitter, timings... of the request
+    sys.stderr.write(reply.get("errors", ""))
+    sys.stderr.flush()
+    return reply["status"]
+
+
+class Daemon:
+    def __init__(self, factory):
+        """
+        factory(options, done) starts a capture with the request options and
+        calls done(status) once it's finished
+        """
+
+        from gi.repository import GLib as glib
+        self.glib = glib
+
+        self.factory = factory
+        self.queue = collections.deque()
+        self.client = None
+        self.recording = None
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+
+        self.path = get_socket_path()
+        if forward({"action": "ping"}) is not None:
+            raise RuntimeError("escrotum daemon already running")
+        if os.path.exists(self.path):
+            # stale socket of a daemon that didn't clean up
+            os.unlink(self.path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only we can connect, from the moment it exists
+        umask = os.umask(0o177)
+        try:
+            self.server.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.server.listen()
+        glib.io_add_watch(self.server.fileno(), glib.IO_IN, self.on_connection)
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def on_connection(self, fd, condition):
+        client, _ = self.server.accept()
+        try:
+            client.settimeout(1)
+            request = json.loads(client.makefile("rb").readline())
+            client.settimeout(None)
+        except (OSError, ValueError):
+            client.close()
+            return True
+
+        self.queue.append((client, request))
+        self.next()
+        return True
+
+    def next(self):
+        """
+        Serve the next queued request, unless there is one in progress
+        """
+
+        if self.client or not self.queue:
+            return False
+
+        self.client, request = self.queue.popleft()
+        # everything printed during the request goes back to the client
+        sys.stdout = io.StringIO()
+        sys.stderr = io.StringIO()
+        try:
+            os.chdir(request.get("cwd", "/"))
+            self.handle(request)
+        except Exception as error:
+            print(error)
+            self.done(1)
+        return False
+
+    def handle(self, request):
+        action = request.get("action")
+        if action == "ping":
+            self.done()
+        elif action == "stop":
+            recording, self.recording = self.recording, None
+            if not recording or not recording.ffmpeg:
+                print("Not recording")
+                self.done(1)
+                return
+            recording.done = self.done
+            recording.stop_recording()
+        elif action == "capture":
+            options = request["options"]
+            if options.get("record") and self.recording:
+                if self.recording.ffmpeg:
+                    print("Already recording")
+                    self.done(1)
+                    return
+            escrotum = self.factory(options, self.done)
+            if options.get("record"):
+                self.recording = escrotum
+        else:
+            print("Unknown action %s" % action)
+            self.done(1)
+
+    def done(self, status=0):
+        """
+        Send the result to the client of the current request
+        """
+
+        output, sys.stdout = sys.stdout.getvalue(), self.stdout
+        errors, sys.stderr = sys.stderr.getvalue(), self.stderr
+        reply = {"status": status, "output": output, "errors": errors}
+        try:
+            self.client.sendall(json.dumps(reply).encode() + b"\n")
+        except OSError:
+            pass
+        self.client.close()
+        self.client = None
+
+        # not inline, done can be called from inside the request handling
+        self.glib.idle_add(self.next)
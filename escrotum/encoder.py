@@ -0,0 +1,651 @@
+"""
+Image encoding, done on worker threads so it doesn't block the main loop
+"""
+
+import os
+import sys
+import zlib
+import struct
+import functools
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import get_numpy, bgra2rgba, get_output_fd
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# rows per strip compressed on its own, big enough to keep the ratio
+STRIP_ROWS = 128
+WORKERS = os.cpu_count() or 1
+# strips being compressed at once by a writer, the memory it takes is about
+# that many strips of STRIP_ROWS rows, filtered and raw, whatever the cores
+MAX_PENDING = min(WORKERS, 4)
+
+PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+# PNG filter types, adaptive picks one per row
+PNG_FILTERS = {
+    "none": 0,
+    "sub": 1,
+    "up": 2,
+    "paeth": 4,
+    "adaptive": None,
+}
+# bytes sampled to pick the filter of a row without numpy
+FILTER_SAMPLE = 8
+# rows subtracted at once without numpy, the python ints are a few copies
+FILTER_ROWS = 16
+# filtered byte -> its distance to 0, as a signed byte
+ABS_BYTES = bytes(min(v, 256 - v) for v in range(256))
+
+# pixels as rows of 8 bits RGB or RGBA, each one starting every rowstride
+# bytes. pixbuf is the GdkPixbuf they come from, if any
+Image = collections.namedtuple(
+    "Image", "width height rowstride channels pixels pixbuf",
+    defaults=(None,))
+
+_pool = None
+_saver = None
+# optional encoders already reported missing
+_missing = set()
+
+
+def get_pool():
+    """
+    Thread pool shared by the encoders, zlib releases the GIL while it
+    compresses so the strips are compressed on all the cores
+    """
+
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+def png_chunk(kind, data):
+    chunk = kind + data
+    return (struct.pack(">I", len(data)) + chunk +
+            struct.pack(">I", zlib.crc32(chunk)))
+
+
+def compress_strip(data, level, strategy):
+    """
+    Raw deflate of a strip, ending byte aligned and not final, so the strips
+    can be concatenated into a single zlib stream
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, strategy)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def subtract_bytes(x, y):
+    """
+    x - y byte by byte, modulo 256, on python ints: the high bit of each
+    byte is set on x and cleared on y so nothing borrows from the next one
+    """
+
+    high, low = get_byte_masks(len(x))
+    a = int.from_bytes(x, "little")
+    b = int.from_bytes(y, "little")
+    diff = ((a | high) - (b & low)) ^ ((a ^ b ^ high) & high)
+    return diff.to_bytes(len(x), "little")
+
+
+@functools.lru_cache(maxsize=4)
+def get_byte_masks(size):
+    return (int.from_bytes(b"\x80" * size, "little"),
+            int.from_bytes(b"\x7f" * size, "little"))
+
+
+def paeth_row(row, previous, bpp):
+    out = bytearray(len(row))
+    for i, x in enumerate(row):
+        a = row[i - bpp] if i >= bpp else 0
+        b = previous[i]
+        c = previous[i - bpp] if i >= bpp else 0
+        pa, pb, pc = abs(b - c), abs(a - c), abs(a + b - 2 * c)
+        if pa <= pb and pa <= pc:
+            predictor = a
+        elif pb <= pc:
+            predictor = b
+        else:
+            predictor = c
+        out[i] = (x - predictor) & 0xff
+    return out
+
+
+def filter_rows(raw, previous, row_size, bpp, png_filter):
+    """
+    Scanlines of the packed rows of raw, each one with its filter type
+    byte. previous is the row above the first one
+    """
+
+    np = get_numpy()
+    if np:
+        return filter_rows_numpy(np, raw, previous, row_size, bpp,
+                                 png_filter)
+
+    scanlines = []
+    for start in range(0, len(raw), row_size):
+        if start % (row_size * FILTER_ROWS) == 0:
+            # FILTER_ROWS at once, the sub of the first pixel of each row is
+            # wrong as it sees the previous row, it's taken as is below
+            chunk = raw[start:start + row_size * FILTER_ROWS]
+            if png_filter in (None, 1):
+                sub = subtract_bytes(chunk, bytes(bpp) + chunk[:-bpp])
+            if png_filter in (None, 2):
+                up = subtract_bytes(chunk, previous + chunk[:-row_size])
+            offset = start
+        end = start + row_size
+        row = raw[start:end]
+        if png_filter in (None, 1):
+            sub_row = row[:bpp] + sub[start - offset + bpp:end - offset]
+        if png_filter is None:
+            candidates = [(0, row), (1, sub_row),
+                          (2, up[start - offset:end - offset])]
+            # the libpng heuristic, the smallest sum of the signed bytes
+            kind, line = min(candidates, key=lambda candidate: sum(
+                candidate[1][::FILTER_SAMPLE].translate(ABS_BYTES)))
+        elif png_filter == 1:
+            kind, line = 1, sub_row
+        elif png_filter == 2:
+            kind, line = 2, up[start - offset:end - offset]
+        elif png_filter == 4:
+            warn_missing("numpy", "the pure python paeth filter is slow")
+            kind, line = 4, paeth_row(row, previous, bpp)
+        else:
+            kind, line = 0, row
+        scanlines.append(bytes((kind,)))
+        scanlines.append(line)
+        previous = row
+    return b"".join(scanlines)
+
+
+def filter_rows_numpy(np, raw, previous, row_size, bpp, png_filter):
+    x = np.frombuffer(raw, dtype=np.uint8).reshape(-1, row_size)
+    rows = len(x)
+    b = np.empty_like(x)
+    b[0] = np.frombuffer(previous, dtype=np.uint8)
+    b[1:] = x[:-1]
+    a = np.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    c = np.zeros_like(x)
+    c[:, bpp:] = b[:, :-bpp]
+
+    def paeth():
+        a16, b16, c16 = (v.astype(np.int16) for v in (a, b, c))
+        pa = np.abs(b16 - c16)
+        pb = np.abs(a16 - c16)
+        pc = np.abs(a16 + b16 - 2 * c16)
+        predictor = np.where((pa <= pb) & (pa <= pc), a,
+                             np.where(pb <= pc, b, c))
+        return x - predictor
+
+    filters = {
+        0: lambda: x,
+        1: lambda: x - a,
+        2: lambda: x - b,
+        3: lambda: x - ((a.astype(np.uint16) + b) >> 1).astype(np.uint8),
+        4: paeth,
+    }
+    out = np.empty((rows, row_size + 1), dtype=np.uint8)
+    if png_filter is not None:
+        out[:, 0] = png_filter
+        out[:, 1:] = filters[png_filter]()
+        return out.tobytes()
+
+    best = None
+    for kind, function in filters.items():
+        filtered = function()
+        # the libpng heuristic, the smallest sum of the signed bytes
+        score = np.abs(filtered.view(np.int8).astype(np.int16)).sum(axis=1)
+        if best is None:
+            best = score
+            out[:, 0] = kind
+            out[:, 1:] = filtered
+            continue
+        better = score < best
+        best = np.where(better, score, best)
+        out[better, 0] = kind
+        out[better, 1:] = filtered[better]
+    return out.tobytes()
+
+
+def filter_and_compress(raw, previous, row_size, bpp, png_filter, level,
+                        strategy):
+    data = filter_rows(raw, previous, row_size, bpp, png_filter)
+    return data, compress_strip(data, level, strategy)
+
+
+class PngWriter:
+    """
+    Writes a PNG to a file object a strip of rows at a time, the strips are
+    filtered and compressed in parallel and written in order
+    """
+
+    def __init__(self, fileobj, width, height, channels, level=6,
+                 strategy=zlib.Z_DEFAULT_STRATEGY, png_filter=None):
+        self.fileobj = fileobj
+        self.row_size = width * channels
+        self.bpp = channels
+        self.level = level
+        self.strategy = strategy
+        # filter type of every row, None to pick the best one per row
+        self.png_filter = png_filter
+        # the filters of the first row see zeros above it
+        self.previous = bytes(self.row_size)
+        self.pool = get_pool()
+        self.pending = collections.deque()
+        self.adler = zlib.adler32(b"")
+
+        color_type = 6 if channels == 4 else 2
+        header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+        fileobj.write(PNG_SIGNATURE)
+        fileobj.write(png_chunk(b"IHDR", header))
+        # zlib header, the deflate blocks come in the next IDAT chunks
+        fileobj.write(png_chunk(b"IDAT", b"\x78\x9c"))
+
+    def write_rows(self, pixels, rowstride, rows):
+        """
+        Add rows of pixels, each one starting every rowstride bytes
+        """
+
+        view = memoryview(pixels)
+        # bigger strips are split, so the memory doesn't depend on them
+        for first in range(0, rows, STRIP_ROWS):
+            raw = b"".join(
+                view[row * rowstride:row * rowstride + self.row_size]
+                for row in range(first, min(first + STRIP_ROWS, rows)))
+            previous, self.previous = self.previous, raw[-self.row_size:]
+
+            self.pending.append(self.pool.submit(
+                filter_and_compress, raw, previous, self.row_size, self.bpp,
+                self.png_filter, self.level, self.strategy))
+            # each pending strip keeps its copy until it's written
+            while len(self.pending) > MAX_PENDING:
+                self.write_pending()
+
+    def write_pending(self):
+        data, compressed = self.pending.popleft().result()
+        # the checksum is of the filtered scanlines, in order
+        self.adler = zlib.adler32(data, self.adler)
+        self.fileobj.write(png_chunk(b"IDAT", compressed))
+
+    def close(self):
+        while self.pending:
+            self.write_pending()
+        # empty final block and the checksum of the whole stream
+        end = zlib.compressobj(self.level, zlib.DEFLATED, -15).flush()
+        end += struct.pack(">I", self.adler)
+        self.fileobj.write(png_chunk(b"IDAT", end))
+        self.fileobj.write(png_chunk(b"IEND", b""))
+
+
+def write_png(fileobj, image, options):
+    """
+    PNG, strips of it are compressed in parallel
+    """
+
+    level = options.get("compression", 6)
+    strategy = PNG_STRATEGIES[options.get("strategy", "default")]
+    writer = PngWriter(fileobj, image.width, image.height, image.channels,
+                       level, strategy,
+                       PNG_FILTERS[options.get("filter", "adaptive")])
+    pixels = memoryview(image.pixels)
+    for first in range(0, image.height, STRIP_ROWS):
+        rows = min(STRIP_ROWS, image.height - first)
+        writer.write_rows(pixels[first * image.rowstride:],
+                          image.rowstride, rows)
+    writer.close()
+
+
+def iter_rows(image):
+    pixels = memoryview(image.pixels)
+    row_size = image.width * image.channels
+    for row in range(image.height):
+        start = row * image.rowstride
+        yield pixels[start:start + row_size]
+
+
+def pam_header(width, height, channels):
+    tupltype = "RGB_ALPHA" if channels == 4 else "RGB"
+    return ("P7\nWIDTH %s\nHEIGHT %s\nDEPTH %s\nMAXVAL 255\n"
+            "TUPLTYPE %s\nENDHDR\n" % (
+                width, height, channels, tupltype)).encode()
+
+
+def ppm_header(width, height, channels):
+    return b"P6\n%d %d\n255\n" % (width, height)
+
+
+def write_pam(fileobj, image, options):
+    """
+    Netpbm PAM, uncompressed RGB or RGBA
+    """
+
+    fileobj.write(pam_header(image.width, image.height, image.channels))
+    write_pam_rows(fileobj, image)
+
+
+def write_pam_rows(fileobj, image):
+    for row in iter_rows(image):
+        fileobj.write(row)
+
+
+def write_ppm(fileobj, image, options):
+    """
+    Netpbm PPM, uncompressed RGB, the alpha is dropped
+    """
+
+    fileobj.write(ppm_header(image.width, image.height, image.channels))
+    write_ppm_rows(fileobj, image)
+
+
+def write_ppm_rows(fileobj, image):
+    rgb = bytearray(image.width * 3)
+    for row in iter_rows(image):
+        if image.channels == 3:
+            fileobj.write(row)
+            continue
+        for channel in range(3):
+            rgb[channel::3] = row[channel::4]
+        fileobj.write(rgb)
+
+
+def write_bgra(fileobj, image, options):
+    """
+    Headerless BGRA rows, the layout of X and cairo images
+    """
+
+    write_bgra_rows(fileobj, image)
+
+
+def write_bgra_rows(fileobj, image):
+    bgra = bytearray(image.width * 4)
+    if image.channels == 3:
+        bgra[3::4] = b"\xff" * image.width
+    for row in iter_rows(image):
+        if image.channels == 4:
+            bgra[:] = row
+            bgra2rgba(bgra, image.width, 1)
+        else:
+            for channel in range(3):
+                bgra[2 - channel::4] = row[channel::3]
+        fileobj.write(bgra)
+
+
+def warn_missing(extra, consequence):
+    """
+    Tell once that an optional dependency is missing
+    """
+
+    if extra in _missing:
+        return
+    _missing.add(extra)
+    sys.stderr.write("%s, pip install escrotum[%s]\n" % (consequence, extra))
+
+
+def write_qoi(fileobj, image, options):
+    """
+    QOI, lossless and way faster to encode than PNG. Uses the qoi module
+    when installed, the pure python encoder is ~10 times slower than PNG
+    """
+
+    np = get_numpy()
+    try:
+        import qoi
+    except ImportError:
+        qoi = None
+
+    if qoi and np:
+        arr = np.frombuffer(image.pixels, dtype=np.uint8,
+                            count=image.rowstride * (image.height - 1) +
+                            image.width * image.channels)
+        arr = np.lib.stride_tricks.as_strided(
+            arr, (image.height, image.width, image.channels),
+            (image.rowstride, image.channels, 1))
+        fileobj.write(qoi.encode(np.ascontiguousarray(arr)))
+    else:
+        warn_missing("qoi", "the pure python qoi encoder is slow")
+        fileobj.write(encode_qoi(image))
+
+
+def encode_qoi(image):
+    channels = image.channels
+    out = bytearray(b"qoif")
+    out += struct.pack(">IIBB", image.width, image.height, channels, 0)
+
+    index = [0] * 64
+    pr, pg, pb, pa = 0, 0, 0, 255
+    run = 0
+    for row in iter_rows(image):
+        alphas = row[3::4] if channels == 4 else [255] * image.width
+        for r, g, b, a in zip(row[0::channels], row[1::channels],
+                              row[2::channels], alphas):
+            if r == pr and g == pg and b == pb and a == pa:
+                run += 1
+                if run == 62:
+                    out.append(0xc0 | 61)
+                    run = 0
+                continue
+            if run:
+                out.append(0xc0 | (run - 1))
+                run = 0
+
+            position = (r * 3 + g * 5 + b * 7 + a * 11) % 64
+            pixel = (r << 24) | (g << 16) | (b << 8) | a
+            if index[position] == pixel:
+                out.append(position)
+            else:
+                index[position] = pixel
+                if a != pa:
+                    out += bytes((0xff, r, g, b, a))
+                else:
+                    vr = (r - pr + 128) % 256 - 128
+                    vg = (g - pg + 128) % 256 - 128
+                    vb = (b - pb + 128) % 256 - 128
+                    vg_r, vg_b = vr - vg, vb - vg
+                    if -3 < vr < 2 and -3 < vg < 2 and -3 < vb < 2:
+                        out.append(0x40 | (vr + 2) << 4 | (vg + 2) << 2 |
+                                   (vb + 2))
+                    elif -33 < vg < 32 and -9 < vg_r < 8 and -9 < vg_b < 8:
+                        out.append(0x80 | (vg + 32))
+                        out.append((vg_r + 8) << 4 | (vg_b + 8))
+                    else:
+                        out += bytes((0xfe, r, g, b))
+            pr, pg, pb, pa = r, g, b, a
+
+    if run:
+        out.append(0xc0 | (run - 1))
+    out += b"\x00" * 7 + b"\x01"
+    return out
+
+
+def write_webp(fileobj, image, options):
+    """
+    WebP through Pillow when installed, so the effort can be tuned,
+    otherwise through the GdkPixbuf loader
+    """
+
+    try:
+        from PIL import Image
+    except ImportError:
+        warn_missing("webp", "--webp-effort is ignored")
+        write_gdk(fileobj, image, options, "webp")
+        return
+
+    mode = "RGBA" if image.channels == 4 else "RGB"
+    img = Image.frombuffer(mode, (image.width, image.height), image.pixels,
+                           "raw", mode, image.rowstride, 1)
+    img.save(fileobj, "WEBP", quality=options.get("quality", 100),
+             method=options.get("effort", 4))
+
+
+def write_gdk(fileobj, image, options, filetype):
+    """
+    Any other format GdkPixbuf can save
+    """
+
+    pb = image.pixbuf
+    if pb is None:
+        from gi.repository import GLib, GdkPixbuf
+        pb = GdkPixbuf.Pixbuf.new_from_bytes(
+            GLib.Bytes.new(image.pixels), GdkPixbuf.Colorspace.RGB,
+            image.channels == 4, 8, image.width, image.height,
+            image.rowstride)
+
+    keys, values = [], []
+    if filetype in ("jpeg", "webp"):
+        keys.append("quality")
+        values.append(str(options.get("quality", 100)))
+    ok, data = pb.save_to_bufferv(filetype, keys, values)
+    fileobj.write(data)
+
+
+# filename extension -> encoder, the rest go to GdkPixbuf
+ENCODERS = {
+    "png": write_png,
+    "pam": write_pam,
+    "ppm": write_ppm,
+    "bgra": write_bgra,
+    "qoi": write_qoi,
+    "webp": write_webp,
+}
+
+
+# formats that can be written a strip of rows at a time, header and rows
+RAW_STRIP_WRITERS = {
+    "pam": (pam_header, write_pam_rows),
+    "ppm": (ppm_header, write_ppm_rows),
+    "bgra": (None, write_bgra_rows),
+}
+STRIP_FORMATS = ("png",) + tuple(RAW_STRIP_WRITERS)
+
+
+class RawWriter:
+    """
+    Writes the uncompressed formats a strip of rows at a time
+    """
+
+    def __init__(self, fileobj, width, height, channels, filetype):
+        self.fileobj = fileobj
+        self.width = width
+        self.channels = channels
+        header, self.write_strip = RAW_STRIP_WRITERS[filetype]
+        if header:
+            fileobj.write(header(width, height, channels))
+
+    def write_rows(self, pixels, rowstride, rows):
+        self.write_strip(self.fileobj, Image(
+            self.width, rows, rowstride, self.channels, pixels))
+
+    def close(self):
+        pass
+
+
+def get_strip_writer(fileobj, width, height, channels, filetype, options):
+    """
+    Writer of filetype that takes the image a strip of rows at a time,
+    with write_rows(pixels, rowstride, rows) and close()
+    """
+
+    if filetype == "png":
+        return PngWriter(
+            fileobj, width, height, channels,
+            options.get("compression", 6),
+            PNG_STRATEGIES[options.get("strategy", "default")],
+            PNG_FILTERS[options.get("filter", "adaptive")])
+    return RawWriter(fileobj, width, height, channels, filetype)
+
+
+def from_pixbuf(pb):
+    return Image(pb.get_width(), pb.get_height(), pb.get_rowstride(),
+                 pb.get_n_channels(), pb.read_pixel_bytes().get_data(), pb)
+
+
+def encode(fileobj, image, filetype, options):
+    """
+    Write the image to fileobj with the encoder of filetype
+    """
+
+    encoder = ENCODERS.get(filetype)
+    if encoder:
+        encoder(fileobj, image, options)
+    else:
+        write_gdk(fileobj, image, options, filetype)
+
+
+def save(pb, filename, filetype, options):
+    """
+    Store the pixbuf on filename, a file or a stream, see open_output
+    """
+
+    image = from_pixbuf(pb)
+    with open_output(filename, options) as fileobj:
+        encode(fileobj, image, filetype, options)
+
+
+def save_strips(strips, filename, filetype, width, height, options):
+    """
+    Store an image that comes as an iterator of pixbufs, strips of its rows
+    from the top. Only the strips being compressed are kept in memory
+    """
+
+    with open_output(filename, options) as fileobj:
+        writer = None
+        for pb in strips:
+            image = from_pixbuf(pb)
+            if writer is None:
+                writer = get_strip_writer(fileobj, width, height,
+                                          image.channels, filetype, options)
+            writer.write_rows(image.pixels, image.rowstride, image.height)
+            # the strip pixels can go before the next one is read
+            del pb, image
+        if writer is None:
+            raise ValueError("no rows to store on %s" % filename)
+        writer.close()
+
+
+@contextlib.contextmanager
+def open_output(filename, options):
+    """
+    File object of filename, streams (- and fd:N) are written as is and left
+    open for the next frames. With the fsync option the file is on disk
+    once it's closed, it's removed if the writing fails
+    """
+
+    fd = get_output_fd(filename)
+    if fd is not None:
+        with os.fdopen(fd, "wb", closefd=False) as fileobj:
+            yield fileobj
+        return
+
+    try:
+        with open(filename, "wb") as fileobj:
+            yield fileobj
+            if options.get("fsync"):
+                fileobj.flush()
+                os.fsync(fileobj.fileno())
+    except BaseException:
+        # a truncated image would look like a valid one
+        with contextlib.suppress(OSError):
+            os.unlink(filename)
+        raise
+
+
+def run_async(function, *args):
+    """
+    Call function on the background saver thread, after the saves queued
+    before it. Returns a Future
+    """
+
+    global _saver
+    if _saver is None:
+        _saver = ThreadPoolExecutor(max_workers=1)
+    return _saver.submit(function, *args)
@@ -1,29 +1,189 @@
 import os
+import math
+import shutil
+import threading
 import subprocess
 from .util import cmd_exists
 
+# length of the segments of a replay, the replay is rounded up to them
+REPLAY_SEGMENT_TIME = 5
+
+# slice counts ffv1 accepts
+FFV1_SLICES = [4, 6, 9, 12, 16, 24, 30]
+
+
+def get_threads(width, height):
+    """
+    Encoder threads, one per 640x360 pixels without going over the cores,
+    more than that only adds overhead
+    """
+
+    cores = os.cpu_count() or 1
+    wanted = math.ceil(width * height / (640 * 360))
+    return max(1, min(cores, wanted))
+
+
+def get_bitrate(width, height, fps):
+    # 0.02 bits per pixel is enough for screen content, ~1.2M on 1080p30
+    return "%dk" % max(500, width * height * fps * 0.02 / 1000)
+
+
+def vp9_args(width, height, fps, threads):
+    # Based on presets from
+    # EasyScreenCast GNOME Extension
+    # Google's Media Core Technologies Live Encoding examples
+    # tiles are at least 256 pixels wide, row-mt runs a thread per column
+    tile_columns = min(int(math.log2(max(width // 256, 1))),
+                       int(math.log2(threads)), 6)
+    # trade quality for speed when each thread gets a lot of pixels
+    load = width * height * fps / threads
+    speed = 8 if load > 1920 * 1080 * 30 / 4 else 7
+    return [
+        '-c:v', 'libvpx-vp9',
+        '-b:v', get_bitrate(width, height, fps),
+        '-quality', 'realtime',
+        '-threads', str(threads),
+        '-speed', str(speed),
+        '-row-mt', '1',
+        '-tile-columns', str(tile_columns),
+        '-frame-parallel', '1',
+        '-qmin', '4',
+        '-qmax', '13']
+
+
+def vp8_args(width, height, fps, threads):
+    return [
+        '-c:v', 'libvpx',
+        '-b:v', get_bitrate(width, height, fps),
+        '-deadline', 'realtime',
+        '-cpu-used', '8',
+        '-threads', str(threads),
+        '-qmin', '4',
+        '-qmax', '30']
+
+
+def h264_args(width, height, fps, threads):
+    return [
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-tune', 'zerolatency',
+        '-crf', '23',
+        '-threads', str(threads),
+        # 4:2:0 needs an even size
+        '-vf', 'crop=trunc(iw/2)*2:trunc(ih/2)*2',
+        '-pix_fmt', 'yuv420p']
+
+
+def ffv1_args(width, height, fps, threads):
+    slices = max(n for n in FFV1_SLICES if n <= max(threads, 4))
+    return [
+        '-c:v', 'ffv1',
+        '-level', '3',
+        '-slices', str(slices),
+        '-slicecrc', '1',
+        '-threads', str(threads)]
+
+
+# name -> codec arguments and the containers that can hold it, the first
+# one is the default extension
+PROFILES = {
+    "vp9": (vp9_args, ["webm", "mkv"]),
+    "vp8": (vp8_args, ["webm", "mkv"]),
+    "h264": (h264_args, ["mp4", "mkv", "mov"]),
+    "ffv1": (ffv1_args, ["mkv"]),
+}
+# extension -> profile picked by auto
+AUTO_PROFILES = {
+    "webm": "vp9",
+    "mp4": "h264",
+    "mov": "h264",
+    "mkv": "ffv1",
+}
+
+
+def get_extension(profile):
+    """
+    Default extension of the profile recordings
+    """
+
+    if profile not in PROFILES:
+        return "webm"
+    return PROFILES[profile][1][0]
+
+
+def get_profile(profile, output):
+    """
+    Resolve auto from the output extension, raises ValueError if the
+    container can't hold the profile codec
+    """
+
+    ext = os.path.splitext(output)[1][1:].lower()
+    if profile == "auto":
+        if ext not in AUTO_PROFILES:
+            raise ValueError("Can't record to .%s, use %s" % (
+                ext, ", ".join(AUTO_PROFILES)))
+        return AUTO_PROFILES[ext]
+    containers = PROFILES[profile][1]
+    if ext not in containers:
+        raise ValueError("%s can't be stored on .%s, use %s" % (
+            profile, ext, ", ".join(containers)))
+    return profile
+
 
 class Ffmpeg:
-    def __init__(self, x, y, w, h, output):
+    def __init__(self, x, y, w, h, output, segment_time=None,
+                 segment_wrap=None, replay=None, profile="auto", fps=30):
+        """
+        Records to output, with segment_time as rolling segments of that many
+        seconds, only the last segment_wrap ones are kept. A replay keeps the
+        segments of the last replay seconds. The segments are joined on
+        output once the recording stops.
+
+        profile is one of PROFILES or auto, the codec settings are tuned for
+        the cores and the size
+        """
+
         self.x, self.y = x, y
         self.w, self.h = w, h
 
         self.output = output
+        self.profile = get_profile(profile, output)
+        self.fps = fps
+        # last values of the ffmpeg progress output
+        self.progress = {}
+        self.reader = None
+
+        if replay:
+            segment_time = min(REPLAY_SEGMENT_TIME, replay)
+            # the one being written isn't on the list, and the oldest on it
+            # may start before the replay
+            segment_wrap = math.ceil(replay / segment_time) + 2
+        self.segment_time = segment_time
+        self.segment_wrap = segment_wrap
+        # seconds kept from the end once joined
+        self.replay = replay
+        # the segments and their list, next to the output
+        self.segments = output + ".segments"
+        self.segment_list = os.path.join(self.segments, "list.ffconcat")
 
         self.display = os.environ["DISPLAY"]
-        if cmd_exists("avconv"):
-            self.binary = "avconv"
-        elif cmd_exists("ffmpeg"):
+        if cmd_exists("ffmpeg"):
             self.binary = "ffmpeg"
+        elif cmd_exists("avconv"):
+            self.binary = "avconv"
         else:
-            raise Exception("ffmpeg or avconv not found")
+            raise OSError("ffmpeg or avconv not found")
+
+    def get_codec_args(self):
+        threads = get_threads(self.w, self.h)
+        codec_args = PROFILES[self.profile][0]
+        return codec_args(self.w, self.h, self.fps, threads) + [
+            '-r', str(self.fps),
+            '-g', str(self.fps * 3)]
 
     def start(self):
         video_input = "%s+%s,%s" % (self.display, self.x, self.y)
         video_size = "%sx%s" % (self.w, self.h)
-        # Based on presets from
-        # EasyScreenCast GNOME Extension
-        # Google's Media Core Technologies Live Encoding examples
         cmd = [
             self.binary,
             '-loglevel', 'error',
@@ -31,32 +191,109 @@ class Ffmpeg:
             '-y',
             '-hide_banner',
             '-video_size', video_size,
+            '-framerate', str(self.fps),
             '-f', 'x11grab',
-            '-i', video_input,
-            # Somewhere in the code the extension is `.mkv`. Assuming VP9.
-            # Google uses 'vp9' only
-            '-c:v', 'libvpx-vp9',
-            '-b:v', '1000k',
-            '-quality', 'realtime',
-            # Get threads automatically? Is it CPU threads?
-            '-threads', '8',
-            '-speed', '7',
-            '-row-mt', '1',
-            '-tile-columns', '3',
-            '-frame-parallel', '1',
-            '-qmin', '4',
-            '-qmax', '13',
-            '-r', '30',
-            '-g', '90',
-            self.output]
+            '-i', video_input] + self.get_codec_args()
+        stdout = None
+        if self.binary == "ffmpeg":
+            # key=value blocks with the frames, drops and speed
+            cmd += ['-progress', 'pipe:1', '-nostats']
+            stdout = subprocess.PIPE
+        cmd += self.get_output_args()
+
         self.proc = subprocess.Popen(
             cmd,
-            stdin=subprocess.PIPE
+            stdin=subprocess.PIPE,
+            stdout=stdout
         )
+        if stdout:
+            self.reader = threading.Thread(target=self.read_progress,
+                                           daemon=True)
+            self.reader.start()
         self.proc.poll()
 
         return self.proc.returncode is None
 
+    def read_progress(self):
+        for line in self.proc.stdout:
+            key, _, value = line.decode(errors="replace").partition("=")
+            if value:
+                self.progress[key.strip()] = value.strip()
+
+    def get_stats(self):
+        """
+        Summary of the progress output, None if ffmpeg didn't report any
+        """
+
+        progress = self.progress
+        if "frame" not in progress:
+            return None
+        return "%s: %s frames, %s dropped, %s duplicated, encoded at %s" % (
+            self.profile, progress["frame"], progress.get("drop_frames", 0),
+            progress.get("dup_frames", 0), progress.get("speed", "?"))
+
+    def get_output_args(self):
+        if not self.segment_time:
+            return [self.output]
+
+        os.makedirs(self.segments, exist_ok=True)
+        ext = os.path.splitext(self.output)[1]
+        args = [
+            '-f', 'segment',
+            '-segment_time', str(self.segment_time),
+            # a keyframe on every segment start, so they are cut on time
+            '-force_key_frames', 'expr:gte(t,n_forced*%s)' % self.segment_time,
+            '-reset_timestamps', '1',
+            '-segment_list', self.segment_list,
+            '-segment_list_type', 'ffconcat']
+        if self.segment_wrap:
+            # the list can't have the segment that is being overwritten
+            args += ['-segment_wrap', str(self.segment_wrap),
+                     '-segment_list_size', str(self.segment_wrap - 1)]
+        return args + [os.path.join(self.segments, "%06d" + ext)]
+
     def stop(self):
-        self.proc.communicate(input=b"q")
+        """
+        Stop the recording, the segments are joined on output. Returns False
+        if they couldn't be
+        """
+
+        try:
+            self.proc.stdin.write(b"q")
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            # already gone
+            pass
         self.proc.wait()
+        if self.reader:
+            self.reader.join()
+        if self.segment_time:
+            return self.join_segments()
+        return True
+
+    def join_segments(self):
+        """
+        Join the segments on the list without encoding them again, they are
+        removed if it works. A replay is cut to its last seconds, from the
+        keyframe before them
+        """
+
+        base = [self.binary, '-loglevel', 'error', '-y', '-hide_banner']
+        # avconv has no -sseof, the replay is a bit longer
+        trim = self.replay and self.binary == "ffmpeg"
+        joined = self.output
+        if trim:
+            ext = os.path.splitext(self.output)[1]
+            joined = os.path.join(self.segments, "joined" + ext)
+
+        cmd = base + ['-f', 'concat', '-i', self.segment_list,
+                      '-c', 'copy', joined]
+        if subprocess.call(cmd) != 0:
+            return False
+        if trim:
+            cmd = base + ['-sseof', '-%s' % self.replay, '-i', joined,
+                          '-c', 'copy', self.output]
+            if subprocess.call(cmd) != 0:
+                return False
+        shutil.rmtree(self.segments)
+        return True
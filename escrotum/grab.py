@@ -0,0 +1,227 @@
+"""
+Grabbing and masking of the screen pixels, shared by the command line and
+the in process API:
+
+    import escrotum
+
+    frame = escrotum.capture(region=(0, 0, 640, 480))
+    png = escrotum.capture(xid=0x1e00007, fmt="png")
+
+    with escrotum.Capturer(region=(0, 0, 640, 480)) as capturer:
+        for _ in range(100):
+            arr = capturer.capture(fmt="numpy")
+
+Errors are raised as CaptureError, nothing exits
+"""
+
+import io
+
+import gi
+
+gi.require_version('Gtk', '3.0')  # noqa: E402
+from gi.repository import Gtk as gtk  # noqa: F401, initializes GDK
+from gi.repository import Gdk as gdk
+import cairo
+
+from .util import get_numpy, get_window_from_xid
+from .encoder import Image, encode, from_pixbuf
+
+# a captured image, pixels are bytes rows of RGB or RGBA every rowstride
+Frame = Image
+
+_monitor_geometries = None
+_monitors_display = None
+_capturer = None
+
+
+class CaptureError(Exception):
+    pass
+
+
+def _invalidate_monitors(display, monitor):
+    global _monitor_geometries
+    _monitor_geometries = None
+
+
+def get_monitor_geometries(display):
+    """
+    Monitor geometries, cached for the whole process until a monitor is
+    added or removed
+    """
+
+    global _monitor_geometries, _monitors_display
+    if _monitors_display != display:
+        _monitors_display = display
+        _monitor_geometries = None
+        display.connect("monitor-added", _invalidate_monitors)
+        display.connect("monitor-removed", _invalidate_monitors)
+
+    if _monitor_geometries is None:
+        monitors = [display.get_monitor(m)
+                    for m in range(display.get_n_monitors())]
+        _monitor_geometries = [m.get_geometry() for m in monitors]
+    return _monitor_geometries
+
+
+def grab_pixbuf(window, x, y, width, height, use_shm=True):
+    """
+    Get the pixels of the window region, through MIT-SHM when available
+    """
+
+    shm = None
+    if use_shm:
+        from .shm import get_shm_capture
+        shm = get_shm_capture()
+    if shm:
+        surface = shm.get_surface(window.get_xid(), x, y, width, height)
+        if surface:
+            return gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+    return gdk.pixbuf_get_from_window(window, x, y, width, height)
+
+
+def mask_pixbuf(pb, x, y, width, height, monitors):
+    """
+    Mask the pixbuf so there is no offscreen garbage on multimonitor setups
+
+    The pixbuf holds the region at x, y of the root window, only the parts
+    not covered by any monitor are painted black, in place
+    """
+
+    uncovered = cairo.Region(cairo.RectangleInt(x, y, width, height))
+    for geo in monitors:
+        uncovered.subtract(
+            cairo.RectangleInt(geo.x, geo.y, geo.width, geo.height))
+
+    # empty when the monitors cover the whole region
+    for i in range(uncovered.num_rectangles()):
+        rect = uncovered.get_rectangle(i)
+        # subpixbufs share the pixels with the parent
+        sub = pb.new_subpixbuf(rect.x - x, rect.y - y,
+                               rect.width, rect.height)
+        sub.fill(0x000000ff)
+
+    return pb
+
+
+def convert(image, fmt, options=None):
+    """
+    The image as a Frame (fmt None), a numpy array (fmt "numpy") or encoded
+    as fmt bytes, any format of the encoders
+    """
+
+    if fmt is None:
+        return image
+    if fmt == "numpy":
+        np = get_numpy()
+        if not np:
+            raise CaptureError("numpy isn't installed")
+        arr = np.frombuffer(image.pixels, dtype=np.uint8,
+                            count=image.rowstride * (image.height - 1) +
+                            image.width * image.channels)
+        arr = np.lib.stride_tricks.as_strided(
+            arr, (image.height, image.width, image.channels),
+            (image.rowstride, image.channels, 1))
+        return np.ascontiguousarray(arr)
+
+    output = io.BytesIO()
+    try:
+        encode(output, image, fmt, options or {})
+    except Exception as error:
+        raise CaptureError("can't encode as %s: %s" % (fmt, error))
+    return output.getvalue()
+
+
+class Capturer:
+    def __init__(self, region=None, xid=None, fmt=None, use_shm=True,
+                 options=None):
+        """
+        Captures of the x, y, width, height region of the root, or of the
+        xid window, the defaults of every capture call. options are the
+        encoder options (compression, strategy, quality and effort)
+        """
+
+        self.display = gdk.Display.get_default()
+        if self.display is None:
+            raise CaptureError("can't open the display")
+        self.region = region
+        self.xid = xid
+        self.fmt = fmt
+        self.use_shm = use_shm
+        self.options = options or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Release the shared memory segment, it's allocated again by the next
+        capture
+        """
+
+        if self.use_shm:
+            from .shm import get_shm_capture
+            shm = get_shm_capture()
+            if shm:
+                shm.free()
+
+    def get_window(self, xid):
+        if not xid:
+            return gdk.get_default_root_window()
+        window = get_window_from_xid(xid)
+        if window is None:
+            raise CaptureError("can't get the window %s" % xid)
+        return window
+
+    def grab(self, region=None, xid=None):
+        """
+        Grab the pixels as a GdkPixbuf, the region is clipped to the window
+        """
+
+        xid = xid or self.xid
+        window = self.get_window(xid)
+        window_width, window_height = window.get_width(), window.get_height()
+        x, y, width, height = (region or self.region or
+                               (0, 0, window_width, window_height))
+        # what is left or above the window is cut, not shifted into it
+        width += min(x, 0)
+        height += min(y, 0)
+        x, y = max(x, 0), max(y, 0)
+        width = min(width, window_width - x)
+        height = min(height, window_height - y)
+        if width <= 0 or height <= 0:
+            raise CaptureError("the region is outside of the window")
+
+        pb = grab_pixbuf(window, x, y, width, height, self.use_shm)
+        if pb is None:
+            raise CaptureError("Invalid Pixbuf")
+        if not xid:
+            mask_pixbuf(pb, x, y, width, height,
+                        get_monitor_geometries(self.display))
+        return pb
+
+    def capture(self, region=None, xid=None, fmt=None):
+        """
+        Capture the region, see convert for the formats
+        """
+
+        image = from_pixbuf(self.grab(region, xid))
+        return convert(image, fmt or self.fmt, self.options)
+
+
+def capture(region=None, xid=None, fmt=None, **kwargs):
+    """
+    Capture the x, y, width, height region of the root, the whole screen by
+    default, or of the xid window. Returns a Frame, a numpy array with fmt
+    "numpy" or the image encoded as fmt ("png", "qoi"...). The display
+    connection is kept for the next calls
+    """
+
+    global _capturer
+    if kwargs:
+        return Capturer(**kwargs).capture(region, xid, fmt)
+    if _capturer is None:
+        _capturer = Capturer()
+    return _capturer.capture(region, xid, fmt)
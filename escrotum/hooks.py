@@ -0,0 +1,147 @@
+"""
+Post capture hooks, the --exec commands. They run on a bounded pool of
+threads, each one with an optional timeout, so escrotum isn't blocked while
+they upload or optimize the file. Commands without shell syntax run without a
+shell, $f $w $h and $n are replaced on each argument.
+
+Detached hooks run on their own session through:
+
+    python -m escrotum.hooks SPEC
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import signal
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# hooks running at once
+HOOK_WORKERS = 4
+
+# anything the shell would interpret, $f $w $h and $n are ours
+SHELL_SYNTAX = re.compile(r"[|&;<>()`\\*?\[\]{}!#\n]|\$(?![fwhn])")
+PLACEHOLDER = re.compile(r"\$([fwhn])")
+
+_runner = None
+
+
+def build(command, values):
+    """
+    Expand the command with values, a dict with the f, w, h and n
+    placeholders. Returns argv and if it has to run on a shell
+    """
+
+    command = time.strftime(command)
+
+    def replace(match):
+        return str(values[match.group(1)])
+
+    if SHELL_SYNTAX.search(command):
+        return PLACEHOLDER.sub(replace, command), True
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        # unbalanced quotes, the shell reports it as it always did
+        return PLACEHOLDER.sub(replace, command), True
+    # placeholders are replaced after splitting, a filename with spaces is
+    # still a single argument
+    return [os.path.expanduser(PLACEHOLDER.sub(replace, arg))
+            for arg in args], False
+
+
+def run_hook(argv, shell, timeout=None, cwd=None, stdout=None):
+    """
+    Run the hook and wait for it, on timeout its whole process group is
+    killed. Returns the exit status, None if it didn't finish. stdout is
+    where its output goes, escrotum's by default
+    """
+
+    try:
+        proc = subprocess.Popen(argv, shell=shell, cwd=cwd,
+                                start_new_session=True,
+                                stdin=subprocess.DEVNULL, stdout=stdout)
+    except OSError as error:
+        sys.stderr.write("hook %s failed: %s\n" % (argv, error))
+        return None
+
+    try:
+        return proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        sys.stderr.write("hook %s killed after %ss\n" % (argv, timeout))
+        return None
+
+
+class HookRunner:
+    def __init__(self, workers=HOOK_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def run(self, hooks, timeout=None, done=None, cwd=None, stdout=None):
+        """
+        Run the (argv, shell) hooks concurrently, done() is called from a
+        worker thread once all of them finished
+        """
+
+        futures = [self.pool.submit(run_hook, argv, shell, timeout, cwd,
+                                    stdout)
+                   for argv, shell in hooks]
+        if not done:
+            return futures
+        if not futures:
+            done()
+            return futures
+
+        remaining = set(futures)
+        lock = threading.Lock()
+
+        def finished(future):
+            with lock:
+                remaining.discard(future)
+                last = not remaining
+            if last:
+                done()
+
+        for future in futures:
+            future.add_done_callback(finished)
+        return futures
+
+
+def get_runner():
+    """
+    Hook runner shared by the process, the daemon runs the hooks of all the
+    requests on it
+    """
+
+    global _runner
+    if _runner is None:
+        _runner = HookRunner()
+    return _runner
+
+
+def detach(hooks, timeout=None, stdout=None):
+    """
+    Run the hooks on a new session that outlives escrotum, they write on
+    stdout
+    """
+
+    from .util import spawn_module
+
+    spec = json.dumps({"hooks": hooks, "timeout": timeout})
+    spawn_module("escrotum.hooks", [spec], stdout=stdout)
+
+
+def main():
+    spec = json.loads(sys.argv[1])
+    runner = HookRunner()
+    runner.run(spec["hooks"], spec["timeout"])
+    runner.pool.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,11 @@
 from gi.repository import Gtk as gtk
 from gi.repository import Gdk as gdk
-from gi.repository import GLib as glib
 
 import xcffib
 import xcffib.xproto
 
+from .util import get_xconnection, add_xevent_handler, remove_xevent_handler
+
 TRIVIAL_MODS = [
     0,
     xcffib.xproto.ModMask.Lock,
@@ -15,21 +16,26 @@ TRIVIAL_MODS = [
 
 class GrabKeyboard:
     def __init__(self, callback, key="<Ctrl><Alt>s"):
-        self.conn = xcffib.connect(display=":0")
+        self.conn = get_xconnection()
 
         self.setup = self.conn.get_setup()
-        self.screen = self.setup.roots[0]
+        self.screen = self.setup.roots[self.conn.pref_screen]
 
         keymap = gdk.Keymap.get_default()
 
         keyval, modifiers = gtk.accelerator_parse(key)
+        found, keys = keymap.get_entries_for_keyval(keyval)
+        if not keyval or not found:
+            raise ValueError("Invalid key %s" % key)
         self.modifiers = int(modifiers)
-        self.keycode = keymap.get_entries_for_keyval(keyval)[1][0].keycode
+        self.keycode = keys[0].keycode
 
         self.callback = callback
+        self.grabbed = False
 
         self.grab_keys()
-        self.poll()
+        # wakes up only when the X connection has something to read
+        add_xevent_handler(self.on_event)
 
     def grab_key(self, key, modifiers):
         self.conn.core.GrabKey(
@@ -45,10 +51,18 @@ class GrabKeyboard:
     def grab_keys(self):
         for mod in TRIVIAL_MODS:
             self.grab_key(self.keycode, self.modifiers | mod)
+        self.grabbed = True
 
-    def poll(self):
-        ev = self.conn.poll_for_event()
-        if type(ev) is xcffib.xproto.KeyReleaseEvent:
-            self.callback()
+    def ungrab_keys(self):
+        if not self.grabbed:
             return
-        glib.timeout_add(100, self.poll)
+        for mod in TRIVIAL_MODS:
+            self.conn.core.UngrabKey(
+                self.keycode, self.screen.root, self.modifiers | mod)
+        self.conn.flush()
+        self.grabbed = False
+        remove_xevent_handler(self.on_event)
+
+    def on_event(self, ev):
+        if self.grabbed and type(ev) is xcffib.xproto.KeyReleaseEvent:
+            self.callback()
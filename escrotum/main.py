@@ -2,23 +2,9 @@
 
 import os
 import sys
-import datetime
-import subprocess
+import re
 import argparse
 
-import gi
-
-gi.require_version('Gtk', '3.0')  # noqa: E402
-from gi.repository import Gtk as gtk
-from gi.repository import Gdk as gdk
-from gi.repository import GdkPixbuf as Pixbuf
-from gi.repository import GLib as glib
-import cairo
-
-from .util import get_selected_window, get_window_from_xid, daemonize, bgra2rgba
-from .ffmpeg import Ffmpeg
-from .keybinding import GrabKeyboard
-
 
 __version__ = "0.2.1"
 
@@ -28,437 +14,19 @@ EXIT_CANT_SAVE_IMAGE = 3
 EXIT_CANCEL = 4
 EXIT_CANT_GRAB_MOUSE = 5
 EXIT_FFMPEG_ERROR = 6
+EXIT_DAEMON_ERROR = 7
 
 
-class Escrotum(gtk.Dialog):
-    def __init__(self, filename=None, selection=False, xid=None, delay=None,
-                 selection_delay=250, countdown=False, use_clipboard=False,
-                 command=None, record=False):
-        super(Escrotum, self).__init__(type=gtk.WindowType.POPUP)
-
-        self.started = False
-        gdk.event_handler_set(self.event_handler)
-
-        self.command = command
-
-        self.clipboard_owner = None
-        self.use_clipboard = use_clipboard
-
-        screen = self.get_screen()
-        self.display = gdk.Display.get_default()
-        self.visual = screen.get_rgba_visual()
-
-        self.rgba_support = False
-        if (self.visual is not None and screen.is_composited()):
-            self.rgba_support = True
-            self.set_visual(self.visual)
-
-        self.filename = filename
-        if not filename:
-            ext = "webm" if record else "png"
-            self.filename = f"%Y-%m-%d-%H%M%S_$wx$h_escrotum.{ext}"
-
-        if record and not self.filename.endswith(".webm"):
-            print("Video recording only supports webm")
-            exit(EXIT_FFMPEG_ERROR)
-
-        self.delay = delay
-        self.selection_delay = selection_delay
-        self.selection = selection
-        self.xid = xid
-        self.countdown = countdown
-        self.record = record
-
-        if not xid:
-            self.root = gdk.get_default_root_window()
-        else:
-            self.root = get_window_from_xid(xid)
-        self.root.show()
-
-        self.x = self.y = 0
-        self.start_x = self.start_y = 0
-        self.height = self.width = 0
-
-        self.set_app_paintable(True)
-
-        self.set_keep_above(True)
-        self.connect("draw", self.on_expose)
-
-        if delay:
-            if countdown:
-                sys.stdout.write("Taking shot in ..%s" % delay)
-                sys.stdout.flush()
-            glib.timeout_add(1000, self.start)
-        else:
-            self.start()
-
-        self.painted = False
-
-    def start(self):
-        if self.delay:
-            self.delay -= 1
-            if self.countdown:
-                sys.stdout.write(" ..%s" % self.delay)
-                sys.stdout.flush()
-            return True
-        if self.delay == 0 and self.countdown:
-            print(".")
-
-        if self.selection and not self.xid:
-            self.grab()
-        else:
-            self.width, self.height = self.root.get_width(), self.root.get_height()
-            self.capture()
-
-    def draw(self):
-        self.painted = True
-        if self.rgba_support or self.width < 4 or self.height < 4:
-            return
-
-        outer = cairo.Region(cairo.RectangleInt(0, 0, self.width, self.height))
-        inner = cairo.Region(
-            cairo.RectangleInt(2, 2, self.width - 4, self.height - 4))
-
-        outer.subtract(inner)
-        self.shape_combine_region(outer)
-
-    def on_expose(self, widget, cr):
-        window = self.get_window()
-        width, height = window.get_width(), window.get_height()
-
-        def set_source(r, g, b, a):
-            if not self.rgba_support:
-                cr.set_source_rgb(r, g, b)
-            else:
-                cr.set_source_rgba(r, g, b, a)
-
-        set_source(255, 255, 255, 0.1)
-        cr.set_operator(cairo.OPERATOR_SOURCE)
-        cr.paint()
-        cr.set_operator(cairo.OPERATOR_OVER)
-
-        set_source(255, 255, 255, 0.8)
-        cr.set_line_width(1)
-        cr.rectangle(0, 0, width, height)
-        cr.set_line_join(cairo.LINE_JOIN_MITER)
-        cr.stroke()
-
-        set_source(0, 0, 0, 0.8)
-        cr.set_line_width(1)
-        cr.rectangle(1, 1, width-1, height-1)
-        cr.set_line_join(cairo.LINE_JOIN_MITER)
-        cr.stroke()
-
-        self.draw()
-
-    def grab(self):
-        """
-        Grab keyboard and mouse
-        """
-
-        seat = self.display.get_default_seat()
-
-        capabilities = (gdk.SeatCapabilities.ALL_POINTING |
-                        gdk.SeatCapabilities.KEYBOARD)
-        owner_events = False
-        cursor = gdk.Cursor(gdk.CursorType.CROSSHAIR)
-        status = seat.grab(self.root, capabilities, owner_events, cursor)
-        if status is not gdk.GrabStatus.SUCCESS:
-            exit(EXIT_CANT_GRAB_MOUSE)
-
-    def ungrab(self):
-        """
-        Ungrab the mouse and keyboard
-        """
-
-        seat = self.display.get_default_seat()
-        seat.ungrab()
-
-    @property
-    def click_selection(self):
-        """
-        if no motion(click and release) it's a selection of a window
-        """
-        return self.width < 5 and self.height < 5
-
-    def event_handler(self, event):
-        """
-        Handle mouse and keyboard events
-        """
-
-        if event.type == gdk.EventType.BUTTON_PRESS:
-            if event.button.button != 1:
-                print("Canceled by the user")
-                exit(EXIT_CANCEL)
-
-            self.started = True
-            self.start_x = int(event.x)
-            self.start_y = int(event.y)
-            self.move(self.x, self.y)
-            self.queue_draw()
-
-        elif event.type == gdk.EventType.KEY_RELEASE:
-            if gdk.keyval_name(event.keyval) == "Escape":
-                print("Canceled by the user")
-                exit(EXIT_CANCEL)
-
-        elif event.type == gdk.EventType.MOTION_NOTIFY:
-            if not self.started:
-                return
-
-            self.set_rect_size(event)
-            self.draw()
-
-            if self.width > 3 and self.height > 3:
-                self.resize(self.width, self.height)
-                self.move(self.x, self.y)
-                self.show_all()
-            self.queue_draw()
-
-        elif event.type == gdk.EventType.BUTTON_RELEASE:
-            if not self.started:
-                return
-
-            self.set_rect_size(event)
-            self.queue_draw()
-
-            self.ungrab()
-            self.wait()
-        else:
-            gtk.main_do_event(event)
-
-    def wait(self):
-        """
-        wait until the window is repainted, so borders/shadows
-        don't appear on the image
-        """
-
-        # if it's a window selection, don't wait
-        if self.click_selection:
-            self.capture()
-            return
-
-        self.painted = False
-        if self.rgba_support:
-            self.set_opacity(0)
-        self.resize(1, 1)
-        self.move(-10, -10)
-
-        def wait():
-            if not self.painted:
-                return True
-            # a delay between hiding selection and the screenshot, looks like
-            # we can't trust in sync between window repaint and composite image
-            # https://github.com/Roger/escrotum/issues/15#issuecomment-85705733
-            glib.timeout_add(self.selection_delay, self.capture)
-
-        glib.timeout_add(10, wait)
-
-    def capture(self):
-        """
-        Capture the image/video based on the window size or the selected window
-        """
-
-        x, y = (self.x, self.y)
-        window = self.root
-        width, height = self.width, self.height
-
-        # get image/video of the selected window
-        if self.click_selection:
-            xid = get_selected_window()
-            if not xid:
-                print("Can't get the xid of the selected window")
-                exit(EXIT_XID_ERROR)
-            selected_window = get_window_from_xid(xid)
-            x, y, width, height = selected_window.get_geometry()
-
-        if self.record:
-            self.capture_video(x, y, width, height)
-        else:
-            self.capture_image(x, y, width, height, window)
-
-    def on_exit(self, width, height):
-        if self.command:
-            command = self.command.replace("$f", self.filename)
-            command = self._expand_argument(width, height, command)
-            subprocess.call(command, shell=True)
-        exit()
-
-    def capture_image(self, x, y, width, height, window):
-        pb = Pixbuf.Pixbuf.new(Pixbuf.Colorspace.RGB, True, 8, width, height)
-        # mask the pixbuf if we have more than one screen
-        root_width, root_height = window.get_width(), window.get_height()
-        pb2 = Pixbuf.Pixbuf.new(Pixbuf.Colorspace.RGB, True, 8,
-                                root_width, root_height)
-        pb2 = gdk.pixbuf_get_from_window(window, 0, 0, root_width, root_height)
-        pb2 = self.mask_pixbuf(pb2, root_width, root_height)
-        pb2.copy_area(x, y, width, height, pb, 0, 0)
-
-        if not pb:
-            print("Invalid Pixbuf")
-            exit(EXIT_INVALID_PIXBUF)
-        if self.use_clipboard:
-            self.save_clipboard(pb)
-        else:
-            self.save_file(pb, width, height)
-
-        if self.command:
-            self.call_exec(width, height)
-
-        # daemonize here so we don't mess with the CWD on subprocess
-        if self.use_clipboard:
-            daemonize()
-        else:
-            # exit here instead of inside save_file
-            self.on_exit(width, height)
-
-    def capture_video(self, x, y, width, height):
-        filename = self._expand_argument(width, height, self.filename)
-        ffmpeg = Ffmpeg(x, y, width, height, filename)
-        if not ffmpeg.start():
-            print("ffmpeg can't record video")
-            exit(EXIT_FFMPEG_ERROR)
-        print("Recording video, stop with Ctrl-Alt-s")
-
-        def wait():
-            ffmpeg.stop()
-            self.on_exit(width, height)
-        GrabKeyboard(wait)
-
-    def get_monitor_geometries(self):
-        monitors = [self.display.get_monitor(m)
-                    for m in range(self.display.get_n_monitors())]
-        return [m.get_geometry() for m in monitors]
-
-    def mask_pixbuf(self, pb, width, height):
-        """
-        Mask the pixbuf so there is no offscreen garbage on multimonitor setups
-        """
-
-        geometries = self.get_monitor_geometries()
-        mask = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        mask_cr = cairo.Context(mask)
-
-        # fill transparent
-        mask_cr.set_source_rgba(0, 0, 0, 0)
-        mask_cr.fill()
-        mask_cr.paint()
-        for geo in geometries:
-            mask_cr.rectangle(geo.x, geo.y, geo.width, geo.height)
-            mask_cr.set_source_rgba(1, 1, 1, 1)
-            mask_cr.fill()
-
-        img = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-
-        cr = cairo.Context(img)
-
-        # fill with the dafault color
-        cr.set_source_rgba(0, 0, 0, 1)
-        cr.fill()
-        cr.paint()
-
-        # use the mask to paint from the pixbuf
-        gdk.cairo_set_source_pixbuf(cr, pb, 0, 0)
-        cr.mask_surface(mask, 0, 0)
-        cr.fill()
-
-        stride = img.get_stride()
-        pixels = img.get_data()
-        data = bgra2rgba(pixels, width, height)
-
-        new_pb = Pixbuf.Pixbuf.new_from_data(data, Pixbuf.Colorspace.RGB,
-                                             True, 8, width, height, stride)
-
-        return new_pb
-
-    def save_clipboard(self, pb):
-        """
-        Save the pixbuf to the clipboard
-        escrotum would be alive until the clipboard owner is changed
-        """
-
-        clipboard = gtk.Clipboard.get(gdk.SELECTION_CLIPBOARD)
-        clipboard.set_image(pb)
-        clipboard.connect("owner-change", self.on_owner_change)
-
-    def on_owner_change(self, clipboard, event):
-        """
-        Handle the selection ownership change
-        XXX: find a better way, i don't know if this can cause a race condition
-        if other application tries to own the clipboard at the same time
-        """
-
-        if not self.clipboard_owner:
-            self.clipboard_owner = event.owner
-        elif self.clipboard_owner != event.owner:
-            exit()
-
-    def _expand_argument(self, width, height, string):
-        string = datetime.datetime.now().strftime(string)
-        string = string.replace("$w", str(width))
-        string = string.replace("$h", str(height))
-        string = os.path.expanduser(string)
-        return string
-
-    def save_file(self, pb, width, height):
-        """
-        Stores the pixbuf as a file
-        """
-
-        self.filename = self._expand_argument(width, height, self.filename)
-
-        filetype = "png"
-        if "." in self.filename:
-            filetype = self.filename.rsplit(".", 1)[1]
-            if filetype == "jpg":
-                filetype = "jpeg"
-
-        optskeys = []
-        optsvalues = []
-        if filetype != "png":
-            optskeys.append("quality")
-            optsvalues.append("100")
-
-        try:
-            pb.savev(self.filename, filetype, optskeys, optsvalues)
-            print(self.filename)
-        except Exception as error:
-            print(error)
-            exit(EXIT_CANT_SAVE_IMAGE)
-
-    def call_exec(self, width, height):
-        filename = '[CLIPBOARD]' if self.use_clipboard else self.filename
-        command = self.command.replace("$f", filename)
-        command = self._expand_argument(width, height, command)
-        subprocess.call(command, shell=True)
-
-    def set_rect_size(self, event):
-        """
-        Set the window size
-        """
+def parse_geometry(value):
+    match = re.match(r"^(\d+)x(\d+)\+(\d+)\+(\d+)$", value)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "invalid geometry %s, expected WIDTHxHEIGHT+X+Y" % value)
+    width, height, x, y = map(int, match.groups())
+    return [x, y, width, height]
 
-        if event.x < self.start_x:
-            x = int(event.x)
-            width = self.start_x - x
-        else:
-            x = self.start_x
-            width = int(event.x) - self.start_x
 
-        self.x = x
-        self.width = width
-
-        if event.y < self.start_y:
-            y = int(event.y)
-            height = self.start_y - y
-        else:
-            height = int(event.y) - self.start_y
-            y = self.start_y
-
-        self.y = y
-        self.height = height
-
-
-def get_options():
+def get_parser():
     epilog = """
   SPECIAL STRINGS
   Both the --exec and filename parameters can take format specifiers
@@ -473,10 +41,40 @@ def get_options():
   \t$f image path/filename (ignored when used in the filename)
   \t$w image width
   \t$h image height
+  \t$n frame number on bursts
   Example:
   \tescrotum '%Y-%m-%d-%H%M%S_$wx$h_escrotum.png'
   \tCreates a file called something like 2013-06-17-082335_263x738_escrotum.png
 
+  HOOKS
+  --exec commands run at the same time, without a shell unless they use
+  shell syntax (pipes, redirections, variables...). Without a shell $f
+  is a single argument even with spaces on it.
+
+  FORMATS
+  The format is picked from the filename extension, besides the ones of
+  GdkPixbuf (jpg, bmp, tiff...) there are:
+  \tpng  with --compression, --png-strategy and --png-filter
+  \tqoi  fast lossless with escrotum[qoi], slower than png without it
+  \twebp with --quality, and --webp-effort with escrotum[webp]
+  \tpam, ppm, bgra uncompressed, bgra is headerless
+  --format overrides it, streams are png unless set.
+
+  RECORDING
+  --profile auto picks the codec from the extension, tuned for the cores
+  and the size of the recording:
+  \twebm vp9, mp4 and mov h264 ultrafast, mkv lossless ffv1
+  vp8 goes on webm too. Without a filename recordings are webm, or the
+  container of the profile. With --transcode the recording is lossless
+  ffv1 and it's encoded with the profile on the background, at the
+  lowest priority, after it stops. The --exec commands run once it's
+  there, list the transcodes with python -m escrotum.transcode
+
+  STREAMS
+  A FILENAME of - writes the image on stdout and fd:N on the inherited file
+  descriptor N, the frames of a burst follow each other. ie:
+  \tescrotum -f bgra -g 640x480+0+0 - | tool
+
   EXIT STATUS CODES
   1 can't get the window by xid
   2 invalid pixbuf
@@ -484,6 +82,7 @@ def get_options():
   4 user canceled selection
   5 can't grab the mouse
   6 error with ffmpeg
+  7 error talking with the daemon
 """
 
     parser = argparse.ArgumentParser(
@@ -501,12 +100,16 @@ def get_options():
     parser.add_argument(
         '-x', '--xid', default=None, type=int,
         help='take a screenshot of the xid window')
+    parser.add_argument(
+        '-g', '--geometry', default=None, type=parse_geometry,
+        help='take a screenshot of the WIDTHxHEIGHT+X+Y rectangle')
     parser.add_argument(
         '-d', '--delay', default=None, type=int,
         help='wait DELAY seconds before taking a shot')
     parser.add_argument(
         '--selection-delay', default=250, type=int,
-        help='delay in milliseconds between selection/screenshot')
+        help='delay in milliseconds between selection/screenshot, when '
+             'the compositor doesn\'t report its frames')
     parser.add_argument(
         '-c', '--countdown', default=False, action="store_true",
         help='show a countdown before taking the shot (requires delay)')
@@ -514,21 +117,124 @@ def get_options():
         '-C', '--clipboard', default=False, action="store_true",
         help='store the image on the clipboard')
     parser.add_argument(
-        '-e', '--exec', default=None, type=str, dest="command",
-        help="run the command after the image is taken")
+        '-e', '--exec', default=[], type=str, dest="commands",
+        action="append", metavar="COMMAND",
+        help="run the command after the image is taken, can be repeated to "
+             "run several commands at once")
+    parser.add_argument(
+        '--hook-timeout', default=None, type=float, metavar="SECONDS",
+        help="kill the --exec commands that run for longer")
+    parser.add_argument(
+        '--detach-hooks', default=False, action="store_true",
+        help="don't wait for the --exec commands, they keep running once "
+             "escrotum exits")
     parser.add_argument(
         '-r', '--record', default=False, action="store_true",
         help="screen recording. Alt+Ctrl+s to stop the recording")
+    parser.add_argument(
+        '--stop-key', default="<Ctrl><Alt>s", metavar="KEY",
+        help="key that stops the recording, default <Ctrl><Alt>s")
+    parser.add_argument(
+        '--segment-time', default=None, type=float, metavar="SECONDS",
+        help="record in segments of SECONDS, they are joined when the "
+             "recording stops")
+    parser.add_argument(
+        '--segment-wrap', default=None, type=int, metavar="SEGMENTS",
+        help="only keep the last SEGMENTS segments, the disk used is bounded")
+    parser.add_argument(
+        '--replay', default=None, type=float, metavar="SECONDS",
+        help="keep recording the last SECONDS, they are saved on the stop key")
+    parser.add_argument(
+        '--profile', default="auto",
+        choices=["auto", "vp9", "vp8", "h264", "ffv1"],
+        help="codec of the recording, auto picks it from the extension")
+    parser.add_argument(
+        '--fps', default=30, type=int,
+        help="frames per second of the recording, default 30")
+    parser.add_argument(
+        '--transcode', default=False, action="store_true",
+        help="record lossless with little CPU, the file is encoded with the "
+             "profile on the background once the recording stops")
+    parser.add_argument(
+        '--transcode-jobs', default=1, type=int, metavar="JOBS",
+        help="recordings transcoded at once, default 1")
+    parser.add_argument(
+        '-b', '--burst', default=1, type=int,
+        help="take BURST shots, one every INTERVAL milliseconds")
+    parser.add_argument(
+        '-i', '--interval', default=1000, type=int,
+        help="milliseconds between the shots of a burst")
+    parser.add_argument(
+        '--timelapse', default=None, metavar="DIR",
+        help="store the burst on DIR as a timelapse, only the parts of the "
+             "screen that changed are kept. --burst 0 runs until Ctrl+C")
+    parser.add_argument(
+        '--ring', default=None, metavar="NAME",
+        help="publish the raw frames of the burst on the NAME shared memory "
+             "ring, read them with python -m escrotum.ring NAME. --burst 0 "
+             "runs until Ctrl+C")
+    parser.add_argument(
+        '--ring-slots', default=8, type=int, metavar="SLOTS",
+        help="frames the ring holds, default 8")
+    parser.add_argument(
+        '--ring-policy', default="drop", choices=["drop", "block"],
+        help="when the ring is full drop the oldest frame, or block up to "
+             "a second until the reader releases it")
+    parser.add_argument(
+        '-f', '--format', default=None, dest="filetype",
+        help="image format, by default the FILENAME extension or png")
+    parser.add_argument(
+        '--strip-height', default=None, type=int, metavar="ROWS",
+        help="grab and encode ROWS rows at a time, the memory used depends on "
+             "the strip and not on the screen size. png and raw formats")
+    parser.add_argument(
+        '--compression', default=6, type=int, choices=range(10),
+        metavar="LEVEL",
+        help="png compression level, 0 (fastest) to 9 (smallest), "
+             "default 6")
+    parser.add_argument(
+        '--png-strategy', default="default",
+        choices=["default", "filtered", "huffman", "rle", "fixed"],
+        help="zlib strategy of the png compression")
+    parser.add_argument(
+        '--png-filter', default="adaptive",
+        choices=["none", "sub", "up", "paeth", "adaptive"],
+        help="png row filter, adaptive picks the best one per row")
+    parser.add_argument(
+        '--quality', default=100, type=int, metavar="QUALITY",
+        help="jpeg and webp quality, 0 to 100, default 100")
+    parser.add_argument(
+        '--webp-effort', default=4, type=int, choices=range(7),
+        metavar="EFFORT",
+        help="webp encoding effort, 0 (fastest) to 6 (smallest), default 4")
+    parser.add_argument(
+        '--timings', default=False, action="store_true",
+        help="report the time spent on every phase of the capture on "
+             "stderr, as JSON. $ESCROTUM_TIMINGS names a file where the "
+             "records are appended")
+    parser.add_argument(
+        '--no-shm', default=True, action="store_false", dest="shm",
+        help="don't use the MIT-SHM extension to read the screen")
+    parser.add_argument(
+        '--daemon', default=False, action="store_true",
+        help="keep running and serve the captures of other escrotum calls")
+    parser.add_argument(
+        '--no-daemon', default=True, action="store_false", dest="use_daemon",
+        help="capture from this process even if a daemon is running")
+    parser.add_argument(
+        '--stop', default=False, action="store_true",
+        help="stop the recording running on the daemon")
     parser.add_argument(
         'FILENAME', type=str, nargs="?",
         help="image filename, default is "
              "%%Y-%%m-%%d-%%H%%M%%S_$wx$h_escrotum.png")
 
-    return parser.parse_args()
+    return parser
 
 
 def run():
-    args = get_options()
+    parser = get_parser()
+    args = parser.parse_args()
 
     if args.version:
         print("escrotum %s" % __version__)
@@ -538,17 +244,148 @@ def run():
         print("Countdown parameter requires delay")
         exit()
 
-    Escrotum(filename=args.FILENAME, selection=args.select, xid=args.xid,
-             delay=args.delay, selection_delay=args.selection_delay,
-             countdown=args.countdown, use_clipboard=args.clipboard,
-             command=args.command, record=args.record)
+    if args.strip_height is not None and args.strip_height < 1:
+        parser.error("Invalid strip height")
+
+    if args.fps < 1:
+        parser.error("Invalid fps")
+
+    if args.transcode and not args.record:
+        parser.error("Transcode requires record")
+
+    if args.transcode_jobs < 1:
+        parser.error("Invalid transcode jobs")
+
+    if args.segment_time or args.segment_wrap or args.replay:
+        if not args.record:
+            parser.error("Segments and replays require record")
+        invalid = (
+            (args.segment_time is not None and args.segment_time <= 0) or
+            (args.replay is not None and args.replay <= 0) or
+            # the wrap needs the segments and can't hold less than two
+            (args.segment_wrap is not None and
+             (args.segment_wrap < 2 or not args.segment_time)))
+        if invalid:
+            parser.error("Invalid segments or replay")
+
+    # modes that take frames until the burst ends, instead of files
+    continuous = args.timelapse or args.ring
+
+    if args.burst < 0 or args.interval < 0 or \
+            (args.burst == 0 and not continuous):
+        parser.error("Invalid burst or interval")
+
+    if args.timelapse and (args.record or args.clipboard):
+        parser.error("Timelapse can't be used with record or clipboard")
+
+    if args.ring and (args.record or args.clipboard or args.timelapse):
+        parser.error("Ring can't be used with record, clipboard or timelapse")
+
+    if args.ring_slots < 1:
+        parser.error("Invalid ring slots")
+
+    # imported here so --version/--help don't pay for them
+    from . import daemon
+    from .util import get_output_fd
+
+    stream = args.FILENAME and get_output_fd(args.FILENAME) is not None
+    if stream:
+        if args.record or args.clipboard or continuous:
+            parser.error("Streams can't be used with record, clipboard, "
+                         "timelapse or ring")
+        if args.FILENAME == "-":
+            # the image goes to stdout, the messages to stderr
+            sys.stdout = sys.stderr
+
+    if args.burst > 1 and not continuous:
+        if args.record or args.clipboard:
+            parser.error("Burst can't be used with record or clipboard")
+        # the frames of a stream are written one after the other
+        if args.FILENAME and "$n" not in args.FILENAME and not stream:
+            parser.error("Burst requires $n on the filename")
+
+    options = dict(
+        filename=args.FILENAME, selection=args.select, xid=args.xid,
+        delay=args.delay, selection_delay=args.selection_delay,
+        countdown=args.countdown, use_clipboard=args.clipboard,
+        commands=args.commands, hook_timeout=args.hook_timeout,
+        detach_hooks=args.detach_hooks, record=args.record, use_shm=args.shm,
+        burst=args.burst, interval=args.interval, geometry=args.geometry,
+        stop_key=args.stop_key, timings=args.timings,
+        timelapse=args.timelapse, filetype=args.filetype,
+        strip_height=args.strip_height, ring=args.ring,
+        ring_slots=args.ring_slots, ring_policy=args.ring_policy,
+        segment_time=args.segment_time, segment_wrap=args.segment_wrap,
+        replay=args.replay, profile=args.profile, fps=args.fps,
+        transcode=args.transcode, transcode_slots=args.transcode_jobs,
+        timings_log=os.environ.get("ESCROTUM_TIMINGS"),
+        encoder_options=dict(
+            compression=args.compression, strategy=args.png_strategy,
+            filter=args.png_filter,
+            quality=args.quality, effort=args.webp_effort))
+
+    if args.daemon:
+        run_daemon()
+        return
+
+    if args.stop:
+        request = {"action": "stop"}
+    else:
+        request = {"action": "capture", "options": options}
+    request["cwd"] = os.getcwd()
+
+    # a timelapse or a ring would keep the daemon busy for their whole
+    # length, and the daemon can't write on our streams
+    if args.stop or (args.use_daemon and not args.countdown and
+                     not continuous and not stream):
+        try:
+            status = daemon.forward(request)
+        except ConnectionError as error:
+            print(error)
+            exit(EXIT_DAEMON_ERROR)
+        if status is not None:
+            exit(status)
+        if args.stop:
+            print("No escrotum daemon running")
+            exit(EXIT_DAEMON_ERROR)
+
+    from .app import Escrotum
+    from gi.repository import Gtk as gtk
+
+    app = Escrotum(**options)
 
     try:
         gtk.main()
     except KeyboardInterrupt:
+        if continuous:
+            # the frames taken so far are already stored
+            app.cleanup()
+            exit()
         print("Canceled by the user")
         exit(EXIT_CANCEL)
 
 
+def run_daemon():
+    from .app import Escrotum
+    from gi.repository import Gtk as gtk
+    from . import daemon
+
+    try:
+        server = daemon.Daemon(
+            lambda options, done: Escrotum(done=done, **options))
+    except (RuntimeError, OSError) as error:
+        print(error)
+        exit(EXIT_DAEMON_ERROR)
+
+    print("escrotum daemon listening on %s" % server.path)
+    sys.stdout.flush()
+    try:
+        gtk.main()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
 if __name__ == "__main__":
     run()
@@ -0,0 +1,305 @@
+"""
+Ring of raw frames on shared memory, escrotum writes the frames and other
+processes map them without copying nor decoding
+
+The segment starts with the ring header, then come the slots, each one
+with its header and the pixels as the rows of the frame every stride bytes
+
+    ring  magic, version, slots, policy, slot size, written, read, closed
+    slot  seq, timestamp, x, y, width, height, stride, channels, pixels
+
+A slot seq is odd while the slot is being written and 2 * n + 2 once it
+holds the frame n, readers check it didn't change after using the pixels.
+With the block policy the writer waits for the reader to release the frames,
+up to BLOCK_TIMEOUT, then it overwrites them until the reader moves again, so
+a missing or dead reader doesn't hang escrotum. With drop the oldest frames
+are overwritten and the reader skips them.
+
+Read the frames of a ring with:
+
+    python -m escrotum.ring NAME [--count FRAMES]
+"""
+
+import sys
+import time
+import struct
+import argparse
+import collections
+from multiprocessing import shared_memory
+
+MAGIC = b"ESCR"
+VERSION = 1
+POLICIES = ["drop", "block"]
+
+RING_HEADER = struct.Struct("<4sIIIQQQQ")
+SLOT_HEADER = struct.Struct("<QdiiIIII")
+# headers are padded so the pixels are aligned
+RING_HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 64
+# offsets of the fields updated once the ring exists
+WRITTEN = 24
+READ = 32
+CLOSED = 40
+
+# seconds between checks while waiting for the other side
+POLL = 0.0005
+# seconds the block policy waits for the reader to release a slot
+BLOCK_TIMEOUT = 1
+
+# seq of the frame, the pixels are a memoryview of the slot
+Frame = collections.namedtuple(
+    "Frame", "seq timestamp x y width height stride channels pixels")
+
+
+def open_shared_memory(name):
+    """
+    Attach to an existing segment, without the resource tracker removing it
+    when this process exits
+    """
+
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+
+    # python < 3.13 always tracks it, unregistering it afterwards would also
+    # drop the registration of the writer when it shares the tracker
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class FrameRing:
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+        (magic, version, self.slots, policy, self.slot_size,
+         written, read, closed) = RING_HEADER.unpack_from(self.buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s isn't an escrotum ring" % shm.name)
+        self.policy = POLICIES[policy]
+        # next frame this reader gets, and the frames it missed. With block
+        # the frames nobody released are still there
+        self.next_seq = read if self.policy == "block" else written
+        self.dropped = 0
+        # read position when the writer gave up waiting for the reader
+        self.stalled = None
+
+    @classmethod
+    def create(cls, name, slots, slot_size, policy="drop"):
+        """
+        New ring of slots frames of up to slot_size bytes
+        """
+
+        size = RING_HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_size)
+        shm = shared_memory.SharedMemory(name, create=True, size=size)
+        RING_HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slots,
+                              POLICIES.index(policy), slot_size, 0, 0, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(open_shared_memory(name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def get_field(self, offset):
+        return struct.unpack_from("<Q", self.buf, offset)[0]
+
+    def set_field(self, offset, value):
+        struct.pack_into("<Q", self.buf, offset, value)
+
+    def slot_offset(self, seq):
+        return (RING_HEADER_SIZE +
+                (seq % self.slots) * (SLOT_HEADER_SIZE + self.slot_size))
+
+    def put(self, image, x=0, y=0, timestamp=None):
+        """
+        Publish the image, an encoder Image. With the block policy waits
+        until the reader released the slot
+        """
+
+        size = image.rowstride * (image.height - 1) + \
+            image.width * image.channels
+        if size > self.slot_size:
+            raise ValueError("the frame doesn't fit on the ring slots")
+
+        seq = self.get_field(WRITTEN)
+        if self.policy == "block":
+            self.wait_reader(seq)
+
+        offset = self.slot_offset(seq)
+        # seq goes first, odd until the pixels are there
+        SLOT_HEADER.pack_into(
+            self.buf, offset, 2 * seq + 1, timestamp or time.time(), x, y,
+            image.width, image.height, image.rowstride, image.channels)
+        start = offset + SLOT_HEADER_SIZE
+        self.buf[start:start + size] = memoryview(image.pixels)[:size]
+        struct.pack_into("<Q", self.buf, offset, 2 * seq + 2)
+        self.set_field(WRITTEN, seq + 1)
+
+    def wait_reader(self, seq):
+        """
+        Wait until the reader releases the slot of seq, without waiting again
+        for a reader that timed out and didn't read anything since
+        """
+
+        read = self.get_field(READ)
+        if read == self.stalled:
+            return
+        self.stalled = None
+        deadline = time.monotonic() + BLOCK_TIMEOUT
+        while seq - read >= self.slots:
+            if time.monotonic() > deadline:
+                self.stalled = read
+                return
+            time.sleep(POLL)
+            read = self.get_field(READ)
+
+    def get(self, timeout=None):
+        """
+        Next frame, None on timeout or once the writer closed the ring. The
+        pixels are only valid until release(frame) says so
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            written = self.get_field(WRITTEN)
+            if self.next_seq >= written:
+                if self.get_field(CLOSED):
+                    return None
+                if deadline is not None and time.monotonic() > deadline:
+                    return None
+                time.sleep(POLL)
+                continue
+
+            # overwritten while we weren't looking
+            if written - self.next_seq > self.slots:
+                self.dropped += written - self.slots - self.next_seq
+                self.next_seq = written - self.slots
+
+            offset = self.slot_offset(self.next_seq)
+            header = SLOT_HEADER.unpack_from(self.buf, offset)
+            if header[0] != 2 * self.next_seq + 2:
+                # being overwritten by a newer frame
+                self.dropped += 1
+                self.next_seq += 1
+                continue
+
+            seq, timestamp, x, y, width, height, stride, channels = header
+            start = offset + SLOT_HEADER_SIZE
+            size = stride * (height - 1) + width * channels
+            return Frame(self.next_seq, timestamp, x, y, width, height,
+                         stride, channels, self.buf[start:start + size])
+
+    def release(self, frame):
+        """
+        Done with the frame, returns False if it was overwritten while it
+        was being used
+        """
+
+        offset = self.slot_offset(frame.seq)
+        valid = self.get_field(offset) == 2 * frame.seq + 2
+        if not valid:
+            self.dropped += 1
+        self.next_seq = frame.seq + 1
+        self.set_field(READ, self.next_seq)
+        try:
+            frame.pixels.release()
+        except BufferError:
+            # still used, ie. by a numpy array
+            pass
+        return valid
+
+    def close(self):
+        """
+        Detach from the ring, the writer also marks it closed and removes
+        it, the readers already attached keep their mapping
+        """
+
+        if self.owner:
+            self.set_field(CLOSED, 1)
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def get_array(frame):
+    """
+    The frame pixels as a height, width, channels numpy array, no copy
+    """
+
+    from .util import get_numpy
+
+    np = get_numpy()
+    arr = np.frombuffer(frame.pixels, dtype=np.uint8)
+    return np.lib.stride_tricks.as_strided(
+        arr, (frame.height, frame.width, frame.channels),
+        (frame.stride, frame.channels, 1))
+
+
+def consume(ring, count=None, report=1.0):
+    """
+    Reference reader, takes the frames as they come and prints the
+    throughput every report seconds. Returns the frames read
+    """
+
+    frames = total = 0
+    start = last = time.monotonic()
+    chunk_frames = chunk_bytes = 0
+    while count is None or frames < count:
+        frame = ring.get(timeout=report)
+        if frame is not None:
+            # touch the pixels, a real reader would run OCR or a diff here
+            size = len(frame.pixels)
+            frame.pixels[0] + frame.pixels[size - 1]
+            if ring.release(frame):
+                frames += 1
+                chunk_frames += 1
+                chunk_bytes += size
+                total += size
+        elif ring.get_field(CLOSED):
+            break
+
+        now = time.monotonic()
+        if now - last >= report:
+            print("%.1f frames/s %.1f MB/s, %s dropped" % (
+                chunk_frames / (now - last),
+                chunk_bytes / (now - last) / 1e6, ring.dropped))
+            sys.stdout.flush()
+            chunk_frames = chunk_bytes = 0
+            last = now
+
+    elapsed = time.monotonic() - start
+    print("%s frames, %.1f MB in %.1fs, %s dropped" % (
+        frames, total / 1e6, elapsed, ring.dropped))
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Read the frames of an escrotum ring")
+    parser.add_argument("NAME")
+    parser.add_argument("--count", default=None, type=int,
+                        help="stop after COUNT frames")
+    args = parser.parse_args()
+
+    ring = FrameRing.attach(args.NAME)
+    try:
+        consume(ring, args.count)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+if __name__ == "__main__":
+    main()
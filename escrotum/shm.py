@@ -0,0 +1,154 @@
+"""
+MIT-SHM capture backend
+
+The X server writes the pixels straight to a shared memory segment, instead
+of sending them through the socket, and the segment is wrapped as a cairo
+surface without copying it
+"""
+
+import os
+import ctypes
+import ctypes.util
+
+import cairo
+import xcffib
+import xcffib.xproto
+import xcffib.shm
+
+from .util import get_xconnection, drains_xevents
+
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+libc.shmget.restype = ctypes.c_int
+libc.shmget.argtypes = (ctypes.c_int, ctypes.c_size_t, ctypes.c_int)
+libc.shmat.restype = ctypes.c_void_p
+libc.shmat.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int)
+libc.shmdt.argtypes = (ctypes.c_void_p,)
+libc.shmctl.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p)
+
+# depth -> cairo format, both use 32 bits per pixel on ZPixmap images
+FORMATS = {
+    24: cairo.FORMAT_RGB24,
+    32: cairo.FORMAT_ARGB32,
+}
+
+_capture = None
+
+
+def is_local_display(display=None):
+    """
+    MIT-SHM only works when the X server runs on this machine
+    """
+
+    display = display or os.environ.get("DISPLAY", "")
+    host = display.rsplit(":", 1)[0]
+    return host in ("", "unix") or host.startswith("/")
+
+
+def get_shm_capture():
+    """
+    Get the shared ShmCapture, None if MIT-SHM isn't available
+    """
+
+    global _capture
+    if _capture is None:
+        _capture = False
+        if is_local_display():
+            try:
+                _capture = ShmCapture(get_xconnection())
+            except Exception:
+                pass
+    return _capture or None
+
+
+def disable_shm_capture():
+    """
+    Stop using MIT-SHM for the rest of the process, freeing the segment
+    """
+
+    global _capture
+    if _capture:
+        _capture.free()
+    _capture = False
+
+
+class ShmCapture:
+    def __init__(self, conn):
+        self.conn = conn
+        self.shm = conn(xcffib.shm.key)
+        # raises if the extension isn't there
+        self.shm.QueryVersion().reply()
+
+        self.shmseg = None
+        self.address = None
+        self.size = 0
+
+    @drains_xevents
+    def allocate(self, size):
+        """
+        Make sure the segment can hold size bytes, reusing it between captures
+        """
+
+        if size <= self.size:
+            return
+        self.free()
+
+        shmid = libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if shmid < 0:
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        address = libc.shmat(shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            libc.shmctl(shmid, IPC_RMID, None)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+
+        shmseg = self.conn.generate_id()
+        try:
+            self.shm.Attach(shmseg, shmid, False, is_checked=True).check()
+        except Exception:
+            # ie. the X server is on another IPC namespace
+            libc.shmdt(address)
+            raise
+        finally:
+            # the segment is released once both sides detach it
+            libc.shmctl(shmid, IPC_RMID, None)
+
+        self.shmseg, self.address, self.size = shmseg, address, size
+
+    def free(self):
+        if self.shmseg is None:
+            return
+        self.shm.Detach(self.shmseg)
+        self.conn.flush()
+        libc.shmdt(self.address)
+        self.shmseg = self.address = None
+        self.size = 0
+
+    @drains_xevents
+    def get_surface(self, xid, x, y, width, height):
+        """
+        Read the region of the window into the segment, returns a cairo
+        surface backed by it, that is only valid until the next capture.
+        None when the region can't be read this way
+        """
+
+        stride = width * 4
+        try:
+            self.allocate(stride * height)
+            reply = self.shm.GetImage(
+                xid, x, y, width, height, 0xffffffff,
+                xcffib.xproto.ImageFormat.ZPixmap, self.shmseg, 0).reply()
+        except Exception:
+            # it would fail again on every capture, GDK takes them from now
+            disable_shm_capture()
+            return None
+
+        fmt = FORMATS.get(reply.depth)
+        if fmt is None or reply.size != stride * height:
+            return None
+
+        data = (ctypes.c_char * reply.size).from_address(self.address)
+        return cairo.ImageSurface.create_for_data(
+            data, fmt, width, height, stride)
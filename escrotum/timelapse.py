@@ -0,0 +1,230 @@
+"""
+Timelapse storage, only the tiles that changed since the previous frame are
+stored, along with an index to rebuild any frame
+
+    DIR/index.jsonl  header line, then a line per frame with its tiles
+    DIR/tiles.bin    zlib compressed tiles, rows of tile pixels
+
+Export a timelapse with:
+
+    python -m escrotum.timelapse DIR --png OUTDIR
+    python -m escrotum.timelapse DIR --video OUTPUT.webm [--fps 30]
+"""
+
+import os
+import sys
+import json
+import zlib
+import argparse
+import subprocess
+
+from .util import get_numpy
+from .encoder import Image, from_pixbuf, write_png
+
+TILE_SIZE = 64
+# every KEYFRAME frames all the tiles are stored, so rebuilding a frame
+# doesn't need to go back to the first one
+KEYFRAME = 250
+
+
+class TimelapseWriter:
+    def __init__(self, directory, width, height, channels, tile=TILE_SIZE,
+                 keyframe=KEYFRAME):
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, "index.jsonl")
+        if os.path.exists(index_path):
+            raise FileExistsError("%s already has a timelapse" % directory)
+
+        self.width, self.height, self.channels = width, height, channels
+        self.tile = tile
+        self.keyframe = keyframe
+        self.frame = 0
+        self.previous = None
+
+        self.index = open(index_path, "w")
+        self.tiles = open(os.path.join(directory, "tiles.bin"), "wb")
+        self.write_index({"width": width, "height": height,
+                          "channels": channels, "tile": tile})
+
+    def write_index(self, entry):
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+
+    def add_pixbuf(self, pb, timestamp):
+        self.add_frame(from_pixbuf(pb), timestamp)
+
+    def add_frame(self, image, timestamp):
+        """
+        Store the tiles of image that changed, returns how many
+        """
+
+        if (image.width, image.height, image.channels) != \
+                (self.width, self.height, self.channels):
+            raise ValueError("the timelapse size can't change")
+
+        frame = pack_rows(image)
+        key = self.frame % self.keyframe == 0
+        if key or self.previous is None:
+            dirty = list(self.iter_tiles())
+        else:
+            dirty = self.dirty_tiles(frame)
+
+        tiles = []
+        for tile_x, tile_y in dirty:
+            data = zlib.compress(self.get_tile(frame, tile_x, tile_y), 1)
+            tiles.append([tile_x, tile_y, self.tiles.tell(), len(data)])
+            self.tiles.write(data)
+        self.tiles.flush()
+
+        self.write_index({"frame": self.frame, "time": timestamp,
+                          "key": key, "tiles": tiles})
+        self.previous = frame
+        self.frame += 1
+        return len(tiles)
+
+    def iter_tiles(self):
+        for tile_y in range(0, self.height, self.tile):
+            for tile_x in range(0, self.width, self.tile):
+                yield tile_x, tile_y
+
+    def get_tile(self, frame, tile_x, tile_y):
+        row_size = self.width * self.channels
+        start = tile_x * self.channels
+        end = min(tile_x + self.tile, self.width) * self.channels
+        rows = range(tile_y, min(tile_y + self.tile, self.height))
+        return b"".join(frame[row * row_size + start:row * row_size + end]
+                        for row in rows)
+
+    def dirty_tiles(self, frame):
+        np = get_numpy()
+        if not np:
+            return [(tile_x, tile_y) for tile_x, tile_y in self.iter_tiles()
+                    if self.get_tile(frame, tile_x, tile_y) !=
+                    self.get_tile(self.previous, tile_x, tile_y)]
+
+        shape = (self.height, self.width, self.channels)
+        current = np.frombuffer(frame, dtype=np.uint8).reshape(shape)
+        previous = np.frombuffer(self.previous, dtype=np.uint8).reshape(shape)
+        changed = (current != previous).any(axis=2)
+
+        # pad to whole tiles, then reduce every tile to a single value
+        tiles_y = -(-self.height // self.tile)
+        tiles_x = -(-self.width // self.tile)
+        padded = np.zeros((tiles_y * self.tile, tiles_x * self.tile),
+                          dtype=bool)
+        padded[:self.height, :self.width] = changed
+        dirty = padded.reshape(
+            tiles_y, self.tile, tiles_x, self.tile).any(axis=(1, 3))
+        return [(int(x) * self.tile, int(y) * self.tile)
+                for y, x in zip(*np.nonzero(dirty))]
+
+    def close(self):
+        self.index.close()
+        self.tiles.close()
+
+
+def pack_rows(image):
+    """
+    The pixels without the rowstride padding
+    """
+
+    row_size = image.width * image.channels
+    if image.rowstride == row_size:
+        return bytes(image.pixels[:row_size * image.height])
+    pixels = memoryview(image.pixels)
+    return b"".join(pixels[row * image.rowstride:][:row_size]
+                    for row in range(image.height))
+
+
+class TimelapseReader:
+    def __init__(self, directory):
+        with open(os.path.join(directory, "index.jsonl")) as index:
+            lines = [json.loads(line) for line in index if line.strip()]
+        header, self.frames = lines[0], lines[1:]
+        self.width, self.height = header["width"], header["height"]
+        self.channels, self.tile = header["channels"], header["tile"]
+        self.tiles = open(os.path.join(directory, "tiles.bin"), "rb")
+
+    def apply(self, frame, entry):
+        row_size = self.width * self.channels
+        for tile_x, tile_y, offset, length in entry["tiles"]:
+            self.tiles.seek(offset)
+            data = zlib.decompress(self.tiles.read(length))
+            tile_row = (min(tile_x + self.tile, self.width) - tile_x) * \
+                self.channels
+            start = tile_x * self.channels
+            for row in range(len(data) // tile_row):
+                position = (tile_y + row) * row_size + start
+                frame[position:position + tile_row] = \
+                    data[row * tile_row:(row + 1) * tile_row]
+
+    def get_frame(self, number):
+        """
+        Rebuild a frame from its last keyframe
+        """
+
+        start = number
+        while start > 0 and not self.frames[start]["key"]:
+            start -= 1
+        frame = bytearray(self.width * self.height * self.channels)
+        for entry in self.frames[start:number + 1]:
+            self.apply(frame, entry)
+        return self.to_image(frame)
+
+    def iter_frames(self):
+        """
+        All the frames in order, applying the tiles incrementally
+        """
+
+        frame = bytearray(self.width * self.height * self.channels)
+        for entry in self.frames:
+            self.apply(frame, entry)
+            yield self.to_image(frame)
+
+    def to_image(self, frame):
+        return Image(self.width, self.height, self.width * self.channels,
+                     self.channels, frame)
+
+
+def export_png(reader, directory):
+    os.makedirs(directory, exist_ok=True)
+    for number, image in enumerate(reader.iter_frames()):
+        filename = os.path.join(directory, "%06d.png" % number)
+        with open(filename, "wb") as fileobj:
+            write_png(fileobj, image, {})
+        print(filename)
+
+
+def export_video(reader, output, fps):
+    pix_fmt = "rgba" if reader.channels == 4 else "rgb24"
+    cmd = ["ffmpeg", "-loglevel", "error", "-y",
+           "-f", "rawvideo", "-pix_fmt", pix_fmt,
+           "-video_size", "%sx%s" % (reader.width, reader.height),
+           "-framerate", str(fps), "-i", "-", output]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    for image in reader.iter_frames():
+        proc.stdin.write(image.pixels)
+    proc.stdin.close()
+    return proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export an escrotum timelapse")
+    parser.add_argument("DIRECTORY")
+    parser.add_argument("--png", metavar="OUTDIR",
+                        help="write every frame as a png on OUTDIR")
+    parser.add_argument("--video", metavar="OUTPUT",
+                        help="encode the frames as a video with ffmpeg")
+    parser.add_argument("--fps", default=30, type=int)
+    args = parser.parse_args()
+
+    reader = TimelapseReader(args.DIRECTORY)
+    if args.png:
+        export_png(reader, args.png)
+    if args.video:
+        sys.exit(export_video(reader, args.video, args.fps))
+
+
+if __name__ == "__main__":
+    main()
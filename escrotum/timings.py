@@ -0,0 +1,103 @@
+"""
+Timing records of the captures, a JSON object per frame with the phases it
+went through, written on stderr with --timings and appended to the file on
+$ESCROTUM_TIMINGS
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+
+
+class Timings:
+    def __init__(self, **fields):
+        """
+        Start the record of a frame, fields are stored as is
+        """
+
+        self.start = time.monotonic()
+        self.wall = time.time()
+        self.fields = fields
+        # name -> [start, end], monotonic seconds
+        self.phases = {}
+        self.pixels = 0
+        self.allocated = 0
+
+    def begin(self, name):
+        self.phases[name] = [time.monotonic(), None]
+
+    def end(self, name):
+        """
+        End the phase if it was started and not ended yet
+        """
+
+        phase = self.phases.get(name)
+        if phase and phase[1] is None:
+            phase[1] = time.monotonic()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def timed(self, name, function):
+        """
+        function wrapped to time its calls as the phase name, it can run on
+        other threads
+        """
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def add_pixels(self, width, height, allocated):
+        self.pixels += width * height
+        self.allocated += allocated
+
+    def record(self):
+        def ms(timestamp):
+            return round((timestamp - self.start) * 1000, 3)
+
+        phases = {}
+        for name, (start, end) in self.phases.items():
+            end = end or time.monotonic()
+            phases[name] = {"start": ms(start), "end": ms(end),
+                            "ms": round((end - start) * 1000, 3)}
+
+        record = dict(self.fields)
+        record.update(
+            time=self.wall, monotonic=self.start, pid=os.getpid(),
+            total_ms=ms(time.monotonic()), phases=phases, pixels=self.pixels,
+            bytes_allocated=self.allocated,
+            # KiB on Linux
+            peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return record
+
+    def report(self, stderr=False, path=None, **fields):
+        """
+        Write the record as a JSON line on stderr and/or appended to path
+        """
+
+        record = self.record()
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + "\n"
+        if stderr:
+            sys.stderr.write(line)
+        if path:
+            try:
+                # a single write, so processes appending at once don't mix
+                fd = os.open(os.path.expanduser(path),
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line.encode())
+                finally:
+                    os.close(fd)
+            except OSError as error:
+                sys.stderr.write("can't write the timings: %s\n" % error)
@@ -0,0 +1,350 @@
+"""
+Background transcode queue of the two phase recordings, escrotum records a
+cheap lossless capture and leaves here the job that encodes it on the final
+file. The jobs are files on the queue directory:
+
+    queue/ID.json       waiting
+    running/ID.PID.json taken by the worker PID, queued again if it dies
+    status/ID.json      state, progress and output of every job
+
+Workers run on their own session at the lowest CPU and IO priority, up to
+as many as slots at once (one flock'ed file per slot). They take the jobs
+until the queue is empty, so they outlive escrotum. The hooks of a job run
+once its output is there.
+
+List the jobs with:
+
+    python -m escrotum.transcode [--clean]
+"""
+
+import os
+import json
+import time
+import fcntl
+import argparse
+import tempfile
+import subprocess
+
+from .ffmpeg import get_bitrate, get_threads
+from .util import cmd_exists, spawn_module
+
+# jobs encoded at once by default
+TRANSCODE_SLOTS = 1
+# seconds between status updates of a running job
+STATUS_INTERVAL = 1
+
+
+def get_queue_dir():
+    cache_dir = (os.environ.get("XDG_CACHE_HOME") or
+                 os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "escrotum", "transcode")
+
+
+def vp9_args(width, height, fps, threads):
+    # constrained quality, no realtime shortcuts, nobody waits for it
+    return [
+        '-c:v', 'libvpx-vp9',
+        '-b:v', get_bitrate(width, height, fps),
+        '-crf', '32',
+        '-deadline', 'good',
+        '-cpu-used', '2',
+        '-threads', str(threads),
+        '-row-mt', '1']
+
+
+def vp8_args(width, height, fps, threads):
+    return [
+        '-c:v', 'libvpx',
+        '-b:v', get_bitrate(width, height, fps),
+        '-crf', '10',
+        '-deadline', 'good',
+        '-cpu-used', '2',
+        '-threads', str(threads)]
+
+
+def h264_args(width, height, fps, threads):
+    return [
+        '-c:v', 'libx264',
+        '-preset', 'medium',
+        '-crf', '23',
+        '-threads', str(threads),
+        '-vf', 'crop=trunc(iw/2)*2:trunc(ih/2)*2',
+        '-pix_fmt', 'yuv420p']
+
+
+# profile -> codec arguments of the final file, slower presets than the
+# recording ones. ffv1 is what gets transcoded
+CODEC_ARGS = {
+    "vp9": vp9_args,
+    "vp8": vp8_args,
+    "h264": h264_args,
+}
+
+
+def write_json(path, data):
+    # readers never see half a file
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class TranscodeQueue:
+    def __init__(self, path=None):
+        self.path = path or get_queue_dir()
+        self.queue = os.path.join(self.path, "queue")
+        self.running = os.path.join(self.path, "running")
+        self.status = os.path.join(self.path, "status")
+        for path in (self.queue, self.running, self.status):
+            os.makedirs(path, exist_ok=True)
+
+    def submit(self, source, output, profile, width, height, fps=30,
+               frames=None, hooks=None, hook_timeout=None, slots=None):
+        """
+        Queue the transcode of source on output and start a worker. frames
+        is the length of the source, for the progress. hooks are the
+        (argv, shell) --exec hooks. Returns the job id
+        """
+
+        if profile not in CODEC_ARGS:
+            raise ValueError("can't transcode to %s" % profile)
+        # sorted by submission
+        now = time.time()
+        job_id = "%s.%06d-%s" % (time.strftime("%Y%m%d%H%M%S",
+                                               time.localtime(now)),
+                                 now % 1 * 1e6, os.getpid())
+        job = dict(id=job_id, source=os.path.abspath(source),
+                   output=os.path.abspath(output), profile=profile,
+                   width=width, height=height, fps=fps, frames=frames,
+                   hooks=hooks or [], hook_timeout=hook_timeout,
+                   cwd=os.getcwd())
+        self.set_status(job, "queued")
+        write_json(os.path.join(self.queue, job_id + ".json"), job)
+        self.spawn_worker(slots or TRANSCODE_SLOTS)
+        return job_id
+
+    def spawn_worker(self, slots):
+        spawn_module("escrotum.transcode",
+                     ["--worker", "--slots", str(slots), "--queue", self.path],
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def set_status(self, job, state, **fields):
+        status = dict(id=job["id"], output=job["output"], state=state,
+                      updated=time.time(), **fields)
+        write_json(os.path.join(self.status, job["id"] + ".json"), status)
+
+    def get_statuses(self):
+        names = sorted(os.listdir(self.status))
+        statuses = [read_json(os.path.join(self.status, name))
+                    for name in names if name.endswith(".json")]
+        return [status for status in statuses if status]
+
+    def acquire_slot(self, slots):
+        """
+        Lock a free slot, the file stays open while the worker has it.
+        None when all of them are taken
+        """
+
+        for slot in range(slots):
+            path = os.path.join(self.path, "slot-%s.lock" % slot)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def take(self):
+        """
+        Move the oldest waiting job to running, None if there are none. The
+        rename is atomic, a single worker gets each job
+        """
+
+        for name in sorted(os.listdir(self.queue)):
+            if not name.endswith(".json"):
+                continue
+            # the pid is part of the claim, so a dead worker is noticed
+            path = os.path.join(self.running, "%s.%s.json" % (
+                name[:-len(".json")], os.getpid()))
+            try:
+                os.rename(os.path.join(self.queue, name), path)
+            except FileNotFoundError:
+                # another worker took it
+                continue
+            job = read_json(path)
+            if job:
+                return job, path
+            os.unlink(path)
+        return None
+
+    def requeue_orphans(self):
+        """
+        Queue again the jobs of the workers that died while running them
+        """
+
+        for name in os.listdir(self.running):
+            job_id, _, pid = name[:-len(".json")].rpartition(".")
+            try:
+                os.kill(int(pid), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except (ValueError, PermissionError):
+                # not ours
+                continue
+            try:
+                os.rename(os.path.join(self.running, name),
+                          os.path.join(self.queue, job_id + ".json"))
+            except FileNotFoundError:
+                # another worker queued it
+                continue
+            job = read_json(os.path.join(self.queue, job_id + ".json"))
+            if job:
+                self.set_status(job, "queued", requeued=True)
+
+    def work(self, slots):
+        """
+        Run the jobs while there are, a worker that finds every slot taken
+        leaves its job to the ones that have them
+        """
+
+        # inherited by ffmpeg
+        os.nice(19)
+        self.requeue_orphans()
+        while True:
+            fd = self.acquire_slot(slots)
+            if fd is None:
+                return
+            try:
+                while True:
+                    taken = self.take()
+                    if not taken:
+                        break
+                    job, path = taken
+                    self.run(job)
+                    os.unlink(path)
+            finally:
+                os.close(fd)
+            # a job queued while the slot was being released, its worker
+            # may have found the slots taken
+            if not any(name.endswith(".json")
+                       for name in os.listdir(self.queue)):
+                return
+
+    def run(self, job):
+        """
+        Transcode the job source, removed once the output is there, and run
+        its hooks
+        """
+
+        from .hooks import HookRunner
+
+        threads = get_threads(job["width"], job["height"])
+        codec_args = CODEC_ARGS[job["profile"]]
+        cmd = []
+        if cmd_exists("ionice"):
+            # idle IO class, it only reads and writes when nobody else does
+            cmd += ["ionice", "-c", "3"]
+        cmd += ["ffmpeg", "-loglevel", "error", "-y", "-hide_banner",
+               "-nostdin", "-i", job["source"]]
+        cmd += codec_args(job["width"], job["height"], job["fps"], threads)
+        cmd += ["-progress", "pipe:1", "-nostats", job["output"]]
+
+        start = time.monotonic()
+        self.set_status(job, "running", progress=0.0, pid=os.getpid())
+        # on a file, a full stderr pipe would block ffmpeg while this
+        # process waits for its progress
+        errors = tempfile.TemporaryFile()
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=errors)
+        except OSError as error:
+            errors.close()
+            self.set_status(job, "failed", error=str(error))
+            return False
+
+        last = 0
+        for line in proc.stdout:
+            key, _, value = line.decode(errors="replace").partition("=")
+            if key != "frame" or not job["frames"]:
+                continue
+            now = time.monotonic()
+            if now - last >= STATUS_INTERVAL:
+                last = now
+                progress = min(int(value) / job["frames"], 1.0)
+                self.set_status(job, "running", progress=progress,
+                                pid=os.getpid())
+        proc.wait()
+        errors.seek(0)
+        error = errors.read().decode(errors="replace").strip()
+        errors.close()
+        if proc.returncode != 0:
+            # the capture is kept, it can be transcoded by hand
+            self.set_status(job, "failed", source=job["source"],
+                            error=error or "ffmpeg exited with %s" %
+                            proc.returncode)
+            return False
+
+        os.unlink(job["source"])
+        elapsed = time.monotonic() - start
+        if job["hooks"]:
+            self.set_status(job, "hooks", progress=1.0, seconds=elapsed)
+            runner = HookRunner()
+            runner.run(job["hooks"], job["hook_timeout"], cwd=job["cwd"])
+            runner.pool.shutdown(wait=True)
+        self.set_status(job, "done", progress=1.0, seconds=elapsed)
+        return True
+
+    def clean(self):
+        """
+        Forget the finished jobs
+        """
+
+        for status in self.get_statuses():
+            if status["state"] in ("done", "failed"):
+                os.unlink(os.path.join(self.status, status["id"] + ".json"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transcode queue of the escrotum recordings")
+    parser.add_argument("--queue", default=None,
+                        help="queue directory, default %s" % get_queue_dir())
+    parser.add_argument("--worker", default=False, action="store_true",
+                        help="run the queued jobs")
+    parser.add_argument("--slots", default=TRANSCODE_SLOTS, type=int,
+                        help="jobs encoded at once")
+    parser.add_argument("--clean", default=False, action="store_true",
+                        help="forget the done and failed jobs")
+    args = parser.parse_args()
+
+    queue = TranscodeQueue(args.queue)
+    if args.worker:
+        queue.work(args.slots)
+        return
+    if args.clean:
+        queue.clean()
+        return
+
+    for status in queue.get_statuses():
+        line = "%s %-7s %s" % (status["id"], status["state"],
+                               status["output"])
+        if status["state"] == "running":
+            line += " %d%%" % (status.get("progress", 0) * 100)
+        elif status["state"] == "failed":
+            line += ": %s" % status.get("error")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,202 @@
 import os
 import sys
+import functools
 
-from gi.repository import GdkX11
+_xconnection = None
+_xevent_handlers = []
+_xevent_watch = None
+_xevent_idle = None
+_atoms = {}
+# xid -> x, y, width, height
+_geometries = {}
+_numpy = None
 
 
+def get_xconnection():
+    """
+    xcffib connection to $DISPLAY shared by the whole process
+    """
+
+    global _xconnection
+    if _xconnection is None:
+        import xcffib
+        _xconnection = xcffib.connect()
+    return _xconnection
+
+
+def add_xevent_handler(handler):
+    """
+    Call handler(event) with the events of the shared connection, they are
+    read as soon as its file descriptor is readable on the GLib main loop
+    """
+
+    global _xevent_watch
+    from gi.repository import GLib as glib
+
+    _xevent_handlers.append(handler)
+    if _xevent_watch is None:
+        _xevent_watch = glib.io_add_watch(
+            get_xconnection().get_file_descriptor(), glib.PRIORITY_DEFAULT,
+            glib.IO_IN, dispatch_xevents)
+    # some may be queued already, read while waiting for a reply
+    queue_xevents()
+
+
+def remove_xevent_handler(handler):
+    if handler in _xevent_handlers:
+        _xevent_handlers.remove(handler)
+
+
+def dispatch_xevents(*args):
+    """
+    Handle all the queued events of the shared connection
+    """
+
+    import xcffib
+
+    conn = get_xconnection()
+    while True:
+        try:
+            event = conn.poll_for_event()
+        except xcffib.ProtocolException:
+            # errors of requests nobody checks, ie. windows that are gone
+            continue
+        if event is None:
+            return True
+        for handler in list(_xevent_handlers):
+            handler(event)
+
+
+def queue_xevents():
+    """
+    Dispatch the events on the next idle. Waiting for a reply reads the
+    events that came before it into xcb, the fd isn't readable for them
+    """
+
+    global _xevent_idle
+    if not _xevent_handlers or _xevent_idle is not None:
+        return
+    from gi.repository import GLib as glib
+    _xevent_idle = glib.idle_add(_dispatch_queued_xevents)
+
+
+def _dispatch_queued_xevents():
+    global _xevent_idle
+    _xevent_idle = None
+    dispatch_xevents()
+    return False
+
+
+def drains_xevents(function):
+    """
+    For the functions that wait for replies on the shared connection, the
+    events read meanwhile are dispatched once they return
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            queue_xevents()
+    return wrapper
+
+
+@drains_xevents
+def get_atom(name):
+    if name not in _atoms:
+        conn = get_xconnection()
+        _atoms[name] = conn.core.InternAtom(
+            False, len(name), name).reply().atom
+    return _atoms[name]
+
+
+@drains_xevents
 def get_selected_window():
     """
-    Ugly workaround to get the selected window, can't use gtk/gdk =/
-    from: http://unix.stackexchange.com/a/16157
+    Get the client window under the pointer, the one with WM_STATE, so
+    reparenting window managers give the window and not its frame
+    """
+
+    import xcffib
+    import xcffib.xproto
+
+    conn = get_xconnection()
+    root = conn.get_setup().roots[conn.pref_screen].root
+    toplevel = conn.core.QueryPointer(root).reply().child
+    # if 0 is root
+    if not toplevel:
+        return root
+
+    wm_state = get_atom("WM_STATE")
+    windows = [toplevel]
+    try:
+        while windows:
+            # ask for all the windows of the level at once
+            cookies = [conn.core.GetProperty(
+                False, window, wm_state, xcffib.xproto.GetPropertyType.Any,
+                0, 0) for window in windows]
+            for window, cookie in zip(windows, cookies):
+                if cookie.reply().type:
+                    return window
+
+            cookies = [conn.core.QueryTree(window) for window in windows]
+            windows = [child for cookie in cookies
+                       for child in cookie.reply().children]
+    except xcffib.ProtocolException:
+        # a window went away while walking the tree
+        pass
+
+    # not managed by a window manager
+    return toplevel
+
+
+@drains_xevents
+def get_window_geometry(xid):
+    """
+    Window position, relative to the root, and size. Cached until the window
+    gets a ConfigureNotify
     """
 
-    from ctypes import CDLL, c_int, c_uint32, c_uint, byref, c_void_p
+    import xcffib
+    import xcffib.xproto
 
-    Xlib = CDLL("libX11.so.6")
-    Xlib.XOpenDisplay.restype = c_void_p
+    conn = get_xconnection()
+    dispatch_xevents()
+    if xid in _geometries:
+        return _geometries[xid]
 
-    display = c_void_p(Xlib.XOpenDisplay(None))
+    if _on_configure not in _xevent_handlers:
+        add_xevent_handler(_on_configure)
 
-    if display == 0:
+    # until the window is configured again
+    conn.core.ChangeWindowAttributes(
+        xid, xcffib.xproto.CW.EventMask,
+        [xcffib.xproto.EventMask.StructureNotify])
+    root = conn.get_setup().roots[conn.pref_screen].root
+    position = conn.core.TranslateCoordinates(xid, root, 0, 0)
+    size = conn.core.GetGeometry(xid)
+    try:
+        position, size = position.reply(), size.reply()
+    except xcffib.ProtocolException:
+        # the window is gone
         return None
 
-    w = Xlib.XRootWindow(display, c_int(0))
+    geometry = (position.dst_x, position.dst_y, size.width, size.height)
+    _geometries[xid] = geometry
+    return geometry
 
-    root_id, child_id = (c_uint32(), c_uint32())
-    root_x, root_y, win_x, win_y = [c_int()] * 4
 
-    mask = c_uint()
-    ret = Xlib.XQueryPointer(display, c_uint32(w),
-                             byref(root_id), byref(child_id),
-                             byref(root_x), byref(root_y),
-                             byref(win_x), byref(win_y),
-                             byref(mask))
-    if ret == 0:
-        return None
+def _on_configure(event):
+    import xcffib.xproto
 
-    value = child_id.value
-    # if 0 is root
-    if value == 0:
-        value = root_id.value
-    return value
+    if isinstance(event, (xcffib.xproto.ConfigureNotifyEvent,
+                          xcffib.xproto.DestroyNotifyEvent)):
+        _geometries.pop(event.window, None)
 
 
 def get_window_from_xid(xid):
+    from gi.repository import GdkX11
     display = GdkX11.X11Display.get_default()
     return GdkX11.X11Window.foreign_new_for_display(display, xid)
 
@@ -91,29 +246,61 @@ def daemonize():
     os.dup2(se.fileno(), sys.stderr.fileno())
 
 
+def get_output_fd(filename):
+    """
+    File descriptor of the stream targets, - is stdout and fd:N the
+    inherited descriptor N. None for the files
+    """
+
+    if filename == "-":
+        return 1
+    if filename.startswith("fd:") and filename[3:].isdigit():
+        return int(filename[3:])
+    return None
+
+
+def get_numpy():
+    """
+    numpy module or None, imported on first use because it's slow to import
+    and not always needed
+    """
+
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
 def bgra2rgba(pixels, width, height):
-    try:
-        # import here because numpy is slow to import
-        # and not always needed
-        import numpy as np
-        HAS_NUMPY = True
-    except ImportError:
-        import array
-        HAS_NUMPY = False
-        print("No numpy support, saving would be slower")
-
-    # GDK wants RGBA but we currently have BGRA, so let's flip R and B
-    if(HAS_NUMPY):
-        arr = np.frombuffer(pixels, dtype=np.uint8)
-        arr.shape = (-1, 4)
-        data = arr[:,[2,1,0,3]]
+    """
+    Swap the R and B channels of the 32 bits pixels, both ways.
+    The swap is done in place when pixels is a writable buffer, otherwise on
+    a copy, returns the converted buffer
+    """
+
+    view = memoryview(pixels).cast("B")
+    if view.readonly:
+        pixels = bytearray(view)
+        view = memoryview(pixels)
+    size = width * height * 4
+
+    np = get_numpy()
+    if np:
+        arr = np.frombuffer(view, dtype=np.uint8, count=size).reshape(-1, 4)
+        blue = arr[:, 0].copy()
+        arr[:, 0] = arr[:, 2]
+        arr[:, 2] = blue
     else:
-        data = array.array ('B', pixels)
-        for x in range (width):
-            for y in range (height):
-                i = (width * y + x) * 4
-                data[i + 0], data[i + 2] = data[i + 2], data[i + 0]
-    return data.tobytes()
+        # strided slices are still done in C, a pixel at a time is way slower
+        view = view[:size]
+        blue = view[0::4].tobytes()
+        view[0::4] = view[2::4]
+        view[2::4] = blue
+    return pixels
 
 
 def cmd_exists(cmd):
@@ -125,3 +312,20 @@ def cmd_exists(cmd):
         os.access(os.path.join(path, cmd), os.X_OK)
         for path in os.environ["PATH"].split(os.pathsep)
     )
+
+
+def spawn_module(module, args, **kwargs):
+    """
+    Run python -m module args on its own session, that outlives escrotum
+    """
+
+    import subprocess
+
+    env = dict(os.environ)
+    # escrotum may not be installed, ie. running from a checkout
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [root, env.get("PYTHONPATH")]))
+    return subprocess.Popen([sys.executable, "-m", module] + args, env=env,
+                            start_new_session=True, stdin=subprocess.DEVNULL,
+                            **kwargs)
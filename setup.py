@@ -16,6 +16,11 @@ setup(
       'xcffib',
       'pycairo',
     ],
+    extras_require={
+      'numpy': ['numpy'],
+      'qoi': ['qoi', 'numpy'],
+      'webp': ['Pillow'],
+    },
     entry_points={
         'console_scripts': [
             'escrotum = escrotum.main:run',
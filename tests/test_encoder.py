@@ -0,0 +1,235 @@
+"""
+The hand written encoders decode back to the same pixels, checked with
+reference decoders on synthetic images so no X server is needed
+"""
+
+import io
+import zlib
+import random
+import struct
+
+import pytest
+
+from escrotum import encoder
+from escrotum.encoder import Image, PNG_FILTERS, STRIP_ROWS
+
+WIDTH = 37
+# more than a strip, the filters of its first row see the one before
+HEIGHT = STRIP_ROWS * 2 + 3
+# bytes after every row, like the pixbuf rowstrides
+PADDING = 5
+
+
+def get_image(channels, seed=0):
+    """
+    Noise and gradients mixed, so the adaptive filter picks different
+    filters and QOI every kind of chunk
+    """
+
+    rand = random.Random(seed)
+    rowstride = WIDTH * channels + PADDING
+    pixels = bytearray()
+    for y in range(HEIGHT):
+        row = bytearray()
+        for x in range(WIDTH):
+            if y % 3 == 0 or x < WIDTH // 3:
+                pixel = [rand.randrange(256) for _ in range(channels)]
+            elif y % 3 == 1:
+                pixel = [(x + y) % 256, (x * 2) % 256, y % 256, 255]
+            else:
+                # long runs
+                pixel = [10, 20, 30, 128]
+            row += bytes(pixel[:channels])
+        pixels += row + b"\xee" * PADDING
+    return Image(WIDTH, HEIGHT, rowstride, channels, bytes(pixels))
+
+
+def get_packed(image):
+    return b"".join(bytes(row) for row in encoder.iter_rows(image))
+
+
+def decode_png(data):
+    """
+    Pixels and filter types of an 8 bits RGB or RGBA PNG
+    """
+
+    assert data[:8] == encoder.PNG_SIGNATURE
+    offset = 8
+    idat = b""
+    while offset < len(data):
+        size, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        body = data[offset + 8:offset + 8 + size]
+        crc, = struct.unpack(">I", data[offset + 8 + size:offset + 12 + size])
+        assert zlib.crc32(kind + body) == crc
+        if kind == b"IHDR":
+            width, height, depth, color_type = struct.unpack(
+                ">IIBB", body[:10])
+        elif kind == b"IDAT":
+            idat += body
+        offset += 12 + size
+    assert kind == b"IEND"
+    assert depth == 8
+
+    bpp = 4 if color_type == 6 else 3
+    row_size = width * bpp
+    # decompress checks the adler32 of the concatenated strips
+    scanlines = zlib.decompress(idat)
+    assert len(scanlines) == height * (row_size + 1)
+
+    pixels = bytearray()
+    kinds = set()
+    previous = bytearray(row_size)
+    for y in range(height):
+        start = y * (row_size + 1)
+        kind = scanlines[start]
+        kinds.add(kind)
+        row = bytearray(scanlines[start + 1:start + 1 + row_size])
+        for i in range(row_size):
+            a = row[i - bpp] if i >= bpp else 0
+            b = previous[i]
+            c = previous[i - bpp] if i >= bpp else 0
+            if kind == 0:
+                predictor = 0
+            elif kind == 1:
+                predictor = a
+            elif kind == 2:
+                predictor = b
+            elif kind == 3:
+                predictor = (a + b) // 2
+            else:
+                assert kind == 4
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    predictor = a
+                elif pb <= pc:
+                    predictor = b
+                else:
+                    predictor = c
+            row[i] = (row[i] + predictor) & 0xff
+        pixels += row
+        previous = row
+    return width, height, bpp, bytes(pixels), kinds
+
+
+def decode_qoi(data):
+    """
+    Pixels of a QOI image, as RGB or RGBA like its header says
+    """
+
+    magic, width, height, channels, _ = struct.unpack(">4sIIBB", data[:14])
+    assert magic == b"qoif"
+    assert data[-8:] == b"\x00" * 7 + b"\x01"
+
+    index = [(0, 0, 0, 0)] * 64
+    r, g, b, a = 0, 0, 0, 255
+    pixels = bytearray()
+    offset = 14
+    end = len(data) - 8
+    while offset < end:
+        byte = data[offset]
+        offset += 1
+        if byte == 0xfe:
+            r, g, b = data[offset:offset + 3]
+            offset += 3
+        elif byte == 0xff:
+            r, g, b, a = data[offset:offset + 4]
+            offset += 4
+        elif byte >> 6 == 0:
+            r, g, b, a = index[byte]
+        elif byte >> 6 == 1:
+            r = (r + (byte >> 4 & 3) - 2) & 0xff
+            g = (g + (byte >> 2 & 3) - 2) & 0xff
+            b = (b + (byte & 3) - 2) & 0xff
+        elif byte >> 6 == 2:
+            vg = (byte & 0x3f) - 32
+            second = data[offset]
+            offset += 1
+            r = (r + vg + (second >> 4) - 8) & 0xff
+            g = (g + vg) & 0xff
+            b = (b + vg + (second & 0xf) - 8) & 0xff
+        else:
+            for _ in range(byte & 0x3f):
+                pixels += bytes((r, g, b, a)[:channels])
+        index[(r * 3 + g * 5 + b * 7 + a * 11) % 64] = (r, g, b, a)
+        pixels += bytes((r, g, b, a)[:channels])
+    assert len(pixels) == width * height * channels
+    return width, height, channels, bytes(pixels)
+
+
+@pytest.fixture(params=["python", "numpy"])
+def numpy_filters(request, monkeypatch):
+    """
+    Runs the PNG tests with both filter implementations
+    """
+
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(encoder, "get_numpy", lambda: None)
+    return request.param
+
+
+@pytest.mark.parametrize("png_filter", list(PNG_FILTERS))
+@pytest.mark.parametrize("channels", [3, 4])
+def test_png_round_trip(channels, png_filter, numpy_filters):
+    image = get_image(channels)
+    fileobj = io.BytesIO()
+    encoder.write_png(fileobj, image, {"filter": png_filter})
+
+    width, height, bpp, pixels, kinds = decode_png(fileobj.getvalue())
+    assert (width, height, bpp) == (WIDTH, HEIGHT, channels)
+    assert pixels == get_packed(image)
+    if png_filter == "adaptive":
+        assert len(kinds) > 1
+    else:
+        assert kinds == {PNG_FILTERS[png_filter]}
+
+
+def test_png_strip_writer(numpy_filters):
+    """
+    Strips of any height end up as the same image
+    """
+
+    image = get_image(4)
+    fileobj = io.BytesIO()
+    writer = encoder.get_strip_writer(fileobj, WIDTH, HEIGHT, 4, "png", {})
+    for first in range(0, HEIGHT, 50):
+        rows = min(50, HEIGHT - first)
+        writer.write_rows(image.pixels[first * image.rowstride:],
+                          image.rowstride, rows)
+    writer.close()
+    assert decode_png(fileobj.getvalue())[3] == get_packed(image)
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_qoi_round_trip(channels):
+    image = get_image(channels)
+    width, height, qoi_channels, pixels = decode_qoi(
+        bytes(encoder.encode_qoi(image)))
+    assert (width, height, qoi_channels) == (WIDTH, HEIGHT, channels)
+    assert pixels == get_packed(image)
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_raw_layouts(channels):
+    image = get_image(channels)
+    packed = get_packed(image)
+    pixels = [packed[i:i + channels] for i in range(0, len(packed), channels)]
+
+    bgra = io.BytesIO()
+    encoder.write_bgra(bgra, image, {})
+    assert bgra.getvalue() == b"".join(
+        bytes((p[2], p[1], p[0], p[3] if channels == 4 else 255))
+        for p in pixels)
+
+    ppm = io.BytesIO()
+    encoder.write_ppm(ppm, image, {})
+    header = b"P6\n%d %d\n255\n" % (WIDTH, HEIGHT)
+    assert ppm.getvalue() == header + b"".join(p[:3] for p in pixels)
+
+    pam = io.BytesIO()
+    encoder.write_pam(pam, image, {})
+    header = encoder.pam_header(WIDTH, HEIGHT, channels)
+    assert b"DEPTH %d\n" % channels in header
+    assert pam.getvalue() == header + packed
@@ -0,0 +1,66 @@
+"""
+The --exec commands run without a shell unless they need one, build decides
+it and expands them
+"""
+
+import time
+
+from escrotum.hooks import build
+
+VALUES = dict(f="/tmp/my shot.png", w=800, h=600, n=1)
+
+
+def test_spaces_without_shell():
+    argv, shell = build("optipng -o2 $f", VALUES)
+    assert not shell
+    assert argv == ["optipng", "-o2", "/tmp/my shot.png"]
+
+
+def test_placeholders_in_arguments():
+    argv, shell = build("echo $wx$h-$n", VALUES)
+    assert not shell
+    assert argv == ["echo", "800x600-1"]
+
+
+def test_quoted_arguments():
+    argv, shell = build("notify-send 'escrotum saved' $f", VALUES)
+    assert not shell
+    assert argv == ["notify-send", "escrotum saved", "/tmp/my shot.png"]
+
+
+def test_pipe_uses_shell():
+    command, shell = build("cat $f | xclip -t image/png", VALUES)
+    assert shell
+    assert command == "cat /tmp/my shot.png | xclip -t image/png"
+
+
+def test_variable_uses_shell():
+    command, shell = build("mv $f $HOME/shots", VALUES)
+    assert shell
+    assert command == "mv /tmp/my shot.png $HOME/shots"
+
+
+def test_unbalanced_quotes_use_shell():
+    command, shell = build("echo 'unbalanced $f", VALUES)
+    assert shell
+    assert command == "echo 'unbalanced /tmp/my shot.png"
+
+
+def test_home_expanded(monkeypatch):
+    monkeypatch.setenv("HOME", "/home/someone")
+    argv, shell = build("cp $f ~/shots/", VALUES)
+    assert not shell
+    assert argv == ["cp", "/tmp/my shot.png", "/home/someone/shots/"]
+
+
+def test_strftime():
+    year = time.strftime("%Y")
+    argv, shell = build("cp $f shots-%Y", VALUES)
+    assert not shell
+    assert argv == ["cp", "/tmp/my shot.png", "shots-" + year]
+
+
+def test_strftime_not_on_values():
+    values = dict(VALUES, f="/tmp/100%d.png")
+    argv, shell = build("echo $f", values)
+    assert argv == ["echo", "/tmp/100%d.png"]
@@ -0,0 +1,32 @@
+"""
+Invalid option combinations are usage errors, reported before anything is
+captured
+"""
+
+import sys
+
+import pytest
+
+from escrotum import main
+
+
+@pytest.mark.parametrize("argv, message", [
+    (["--fps", "0"], "Invalid fps"),
+    (["--strip-height", "0"], "Invalid strip height"),
+    (["--transcode"], "Transcode requires record"),
+    (["-r", "--transcode-jobs", "0"], "Invalid transcode jobs"),
+    (["--replay", "30"], "Segments and replays require record"),
+    (["-r", "--segment-wrap", "1"], "Invalid segments or replay"),
+    (["-b", "-1"], "Invalid burst or interval"),
+    (["--timelapse", "shots", "-r"], "Timelapse can't be used"),
+    (["--ring", "shots", "-C"], "Ring can't be used"),
+    (["--ring-slots", "0"], "Invalid ring slots"),
+    (["-r", "-"], "Streams can't be used"),
+    (["-b", "3", "shot.png"], "Burst requires $n"),
+])
+def test_usage_errors(argv, message, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["escrotum"] + argv)
+    with pytest.raises(SystemExit) as exit_info:
+        main.run()
+    assert exit_info.value.code == 2
+    assert message in capsys.readouterr().err
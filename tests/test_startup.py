@@ -0,0 +1,52 @@
+"""
+escrotum.main has to start fast, GTK and friends are only imported when the
+requested mode needs them
+"""
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cumulative import time of escrotum.main, in microseconds
+STARTUP_BUDGET = 25000
+
+
+def run_python(code, *args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [ROOT, env.get("PYTHONPATH")]))
+    return subprocess.run([sys.executable] + list(args) + ["-c", code],
+                          env=env, capture_output=True, text=True, check=True)
+
+
+def test_import_time():
+    stderr = run_python("import escrotum.main", "-X", "importtime").stderr
+    total = 0
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # only the top level ones, the nested are part of them
+        if name[1:] == name.strip() and name.strip().startswith("escrotum"):
+            total += int(cumulative)
+    assert 0 < total <= STARTUP_BUDGET
+
+
+def test_version_loads_no_gui():
+    code = "\n".join([
+        "import sys",
+        "from escrotum import main",
+        "sys.argv = ['escrotum', '--version']",
+        "try:",
+        "    main.run()",
+        "except SystemExit:",
+        "    pass",
+        "loaded = [m for m in ('gi', 'cairo', 'xcffib') if m in sys.modules]",
+        "print(','.join(loaded))",
+    ])
+    version, loaded = run_python(code).stdout.splitlines()
+    assert version.startswith("escrotum ")
+    assert loaded == ""
@@ -0,0 +1,88 @@
+"""
+Images written a strip at a time keep the peak RSS flat whatever their
+height, fed with synthetic strips so no X server is needed
+"""
+
+import os
+import sys
+import zlib
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WIDTH = 4096
+HEIGHT = 16384
+STRIP_HEIGHT = 256
+# the whole image is 256MiB, the strips being compressed are far less
+RSS_BUDGET = 64 * 1024
+
+WRITE_STRIPS = """
+import os
+import sys
+import resource
+
+width, height, strip_height, filetype, path, cores = sys.argv[1:]
+if cores != "0":
+    # the strips in flight can't grow with the cores
+    os.cpu_count = lambda: int(cores)
+from escrotum.encoder import get_strip_writer
+
+width, height, strip_height = int(width), int(height), int(strip_height)
+strip = bytes(range(256)) * (width * 4 * strip_height // 256)
+
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+with open(path, "wb") as fileobj:
+    writer = get_strip_writer(fileobj, width, height, 4, filetype,
+                              {"compression": 1})
+    for top in range(0, height, strip_height):
+        rows = min(strip_height, height - top)
+        writer.write_rows(strip, width * 4, rows)
+    writer.close()
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(after - before)
+"""
+
+
+def write_strips(filetype, path, cores=0):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [ROOT, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-c", WRITE_STRIPS, str(WIDTH), str(HEIGHT),
+         str(STRIP_HEIGHT), filetype, str(path), str(cores)],
+        env=env, capture_output=True, text=True, check=True)
+    # KiB the peak RSS grew while writing
+    return int(result.stdout)
+
+
+@pytest.mark.parametrize("filetype", ["png", "pam"])
+def test_peak_rss(filetype, tmp_path):
+    path = tmp_path / ("image." + filetype)
+    assert write_strips(filetype, path) < RSS_BUDGET
+
+
+def test_peak_rss_many_cores(tmp_path):
+    assert write_strips("png", tmp_path / "image.png", 32) < RSS_BUDGET
+
+
+def test_png_rows(tmp_path):
+    path = tmp_path / "image.png"
+    write_strips("png", path)
+    data = path.read_bytes()
+    assert data.endswith(b"IEND\xaeB`\x82")
+
+    # the IDAT payloads are a single zlib stream with every row
+    idat = b""
+    offset = 8
+    while offset < len(data):
+        size = int.from_bytes(data[offset:offset + 4], "big")
+        if data[offset + 4:offset + 8] == b"IDAT":
+            idat += data[offset + 8:offset + 8 + size]
+        offset += 12 + size
+    decompress = zlib.decompressobj()
+    rows = 0
+    for start in range(0, len(idat), 1 << 20):
+        rows += len(decompress.decompress(idat[start:start + (1 << 20)]))
+    assert rows == HEIGHT * (WIDTH * 4 + 1)